@@ -205,19 +205,22 @@ def main():
 
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
         client_socket.settimeout(10)
+        resolutionStart = time.perf_counter()
 
         for hostName in rootServers:
             try:
-                startTime = time.time()
-                endTime = time.time()
+                # time each request on its own, from send to reply
+                startTime = time.perf_counter()
 
                 client_socket.sendto(request, (rootServers[hostName], 53))
 
                 response, addr = client_socket.recvfrom(1024)
+                endTime = time.perf_counter()
 
                 if response:
                     # unpack DNS record + type + ip addresses
                     print(f"Response from: {hostName}")
+                    print(f"The RTT between this machine and {hostName} was {round(endTime - startTime, 5)} seconds")
                     rootResponse = response
                     break
             except socket.timeout:
@@ -236,13 +239,16 @@ def main():
 
             for hostName in ipv4:
                 try:
+                    startTime = time.perf_counter()
                     client_socket.sendto(request, (hostName["ip"], 53))
 
                     response, addr = client_socket.recvfrom(1024)
+                    endTime = time.perf_counter()
 
                     if response:
                         # unpack DNS record + type + ip addresses
                         print(f"Response from: {hostName}")
+                        print(f"The RTT between this machine and {hostName['name']} was {round(endTime - startTime, 5)} seconds")
                         tldResponse = response
                         break
                 except socket.timeout:
@@ -260,13 +266,16 @@ def main():
 
                 for hostName in ipv4:
                     try:
+                        startTime = time.perf_counter()
                         client_socket.sendto(request, (hostName["ip"], 53))
 
                         response, addr = client_socket.recvfrom(1024)
+                        endTime = time.perf_counter()
 
                         if response:
                             # unpack DNS record + type + ip addresses
                             print(f"Response from: {hostName}")
+                            print(f"The RTT between this machine and {hostName['name']} was {round(endTime - startTime, 5)} seconds")
                             authResponse = response
                             break
                     except socket.timeout:
@@ -277,10 +286,10 @@ def main():
                     )
 
                     print("\nAuthoritative Server Response:")
-                    endTime = time.time()
-                    rtt = round(endTime - startTime, 5)
+                    # root, TLD and authoritative round trips plus any timeouts on the way
+                    total = round(endTime - resolutionStart, 5)
                     print(
-                        f"The RTT between this machine and the public DNS resolver was {rtt} seconds"
+                        f"Resolving {siteName} took {total} seconds in total"
                     )
                     
                     print(f"Header: {header}")
@@ -296,8 +305,7 @@ def main():
                             try:
                                 tcp_socket.connect((hostName["ip"], 80))
 
-                                startTime = time.time()
-                                endTime = time.time()
+                                startTime = time.perf_counter()
 
                                 httpReq = (
                                     f"GET / HTTP/1.1\r\n"
@@ -317,7 +325,7 @@ def main():
                                     if data:
                                         response += data
                                     else:
-                                        endTime = time.time()
+                                        endTime = time.perf_counter()
                                         break
 
                                 if response:
@@ -0,0 +1,502 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+import struct
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from dnscache import DNSCache
+from dnsasync import CONCURRENCY, MAX_IN_FLIGHT, SOCKET_BUFFER_SIZE, AsyncResolver
+from dnsclient import createQuery, decodeResponse, query_templates
+from dnsmessage import RECORD, TYPE_A, TYPE_AAAA, TYPE_NS, parseMessage
+from dnsservers import NameserverTable
+
+# the fake hierarchy listens on one port at several loopback addresses, which
+# works out of the box on Linux (other systems need the addresses aliased)
+PORT = 10153
+ROOT_ADDRESSES = ["127.0.0.2", "127.0.0.3"]
+TLD_ADDRESSES = ["127.0.1.1", "127.0.1.2"]
+AUTH_NETWORK = "127.0.2."
+AUTH_SERVERS = 4
+TLDS = ("com", "net", "org")
+DOMAINS = 1000
+SIZES = (1000, 10000)
+PARSER_ITERATIONS = 20000
+TIMEOUT = 1.0
+
+RCODE_NXDOMAIN = 3
+
+
+class Tier:
+    """
+    How one level of the fake hierarchy misbehaves: added latency (with
+    uniform jitter), the fraction of queries silently dropped and the
+    fraction answered over UDP with only TC set
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, truncate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.truncate = truncate
+
+    @classmethod
+    def parse(cls, spec):
+        """
+        Parse "latency=5,jitter=2,loss=0.01,truncate=0.1" (times in ms)
+        """
+        tier = cls()
+        for item in filter(None, spec.split(",")):
+            key, _, value = item.partition("=")
+            if key not in ("latency", "jitter", "loss", "truncate"):
+                raise argparse.ArgumentTypeError(f"unknown tier setting {key!r}")
+            value = float(value)
+            setattr(tier, key, value / 1000 if key in ("latency", "jitter") else value)
+        return tier
+
+    def delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def __str__(self):
+        settings = [("latency", self.latency * 1000), ("jitter", self.jitter * 1000),
+                    ("loss", self.loss), ("truncate", self.truncate)]
+        return ",".join(f"{key}={value:g}" for key, value in settings if value) or "-"
+
+
+def auth_addresses(count):
+    return [f"{AUTH_NETWORK}{i + 1}" for i in range(count)]
+
+
+class MessageWriter:
+    """
+    Builds a DNS message with name compression, like a real server would,
+    so the parser benchmark sees realistic pointer chains
+    """
+
+    def __init__(self, header, question):
+        self.parts = [header, question]
+        self.size = len(header) + len(question)
+        self.offsets = {}
+
+        # let answers point back into the question name
+        labels = []
+        offset = 0
+        while offset < len(question) and question[offset]:
+            labels.append((len(header) + offset, str(question[offset + 1 : offset + 1 + question[offset]], "utf-8")))
+            offset += 1 + question[offset]
+        for i, (start, _) in enumerate(labels):
+            self.offsets[".".join(label for _, label in labels[i:]).lower()] = start
+
+    def name(self, name):
+        labels = name.rstrip(".").split(".") if name.strip(".") else []
+        encoded = []
+        for i in range(len(labels)):
+            suffix = ".".join(labels[i:]).lower()
+            pointer = self.offsets.get(suffix)
+            if pointer is not None:
+                encoded.append(struct.pack("!H", 0xC000 | pointer))
+                break
+            if self.size < 0x3FFF:
+                self.offsets[suffix] = self.size
+            label = labels[i].encode("utf-8")
+            encoded.append(bytes([len(label)]) + label)
+            self.size += 1 + len(label)
+        else:
+            encoded.append(b"\x00")
+            self.size += 1
+            self.parts.extend(encoded)
+            return
+        self.size += 2
+        self.parts.extend(encoded)
+
+    def record(self, name, typeDNS, ttl, rdata):
+        self.name(name)
+        if typeDNS in (TYPE_A, TYPE_AAAA):
+            data = socket.inet_pton(socket.AF_INET if typeDNS == TYPE_A else socket.AF_INET6, rdata)
+            self.parts.append(RECORD.pack(typeDNS, 1, ttl, len(data)))
+            self.parts.append(data)
+            self.size += RECORD.size + len(data)
+        else:
+            self.parts.append(b"")
+            length_index = len(self.parts) - 1
+            self.size += RECORD.size
+            start = self.size
+            self.name(rdata)
+            self.parts[length_index] = RECORD.pack(typeDNS, 1, ttl, self.size - start)
+
+    def getvalue(self):
+        return b"".join(self.parts)
+
+
+def buildMessage(qid, question, rcode=0, answers=(), authority=(), additional=(), authoritative=False):
+    """
+    Build a response; each record is a (name, type, ttl, rdata) tuple with
+    rdata given as an address or a domain name
+    """
+    flags = 0x8000 | (0x0400 if authoritative else 0) | rcode
+    header = struct.pack("!HHHHHH", qid, flags, 1 if question else 0, len(answers), len(authority), len(additional))
+    writer = MessageWriter(header, question)
+    for section in (answers, authority, additional):
+        for record in section:
+            writer.record(*record)
+    return writer.getvalue()
+
+
+class FakeHierarchy:
+    """
+    Answers queries as the root, a TLD or an authoritative server for the
+    synthetic zones: TLDS are delegated to TLD_ADDRESSES, d<N>.<tld> to two
+    of the auth servers, and every name under d<N>.<tld> has an A record
+    (names starting with "nx" get NXDOMAIN).
+    """
+
+    def __init__(self, auth_count=AUTH_SERVERS):
+        self.auth = auth_addresses(auth_count)
+
+    def respond(self, role, query):
+        message = parseMessage(query)
+        question = message.question
+        if question is None:
+            return None
+        question_end = message.skipName(12) + 4
+        qid, qsection = message.header.id, bytes(query[12:question_end])
+        name = question.name.lower().rstrip(".")
+        labels = name.split(".")
+
+        if role == "root":
+            if labels[-1] not in TLDS:
+                return buildMessage(qid, qsection, RCODE_NXDOMAIN, authoritative=True)
+            tld = labels[-1]
+            servers = [f"{letter}.nic.{tld}" for letter in "ab"[: len(TLD_ADDRESSES)]]
+            return buildMessage(
+                qid, qsection,
+                authority=[(tld, TYPE_NS, 172800, server) for server in servers],
+                additional=[(server, TYPE_A, 172800, ip) for server, ip in zip(servers, TLD_ADDRESSES)],
+            )
+
+        if role == "tld":
+            domain = ".".join(labels[-2:])
+            if len(labels) < 2 or not labels[-2][1:].isdigit():
+                return buildMessage(qid, qsection, RCODE_NXDOMAIN, authoritative=True)
+            index = int(labels[-2][1:])
+            ips = [self.auth[index % len(self.auth)], self.auth[(index + 1) % len(self.auth)]]
+            servers = [f"ns{i + 1}.{domain}" for i in range(len(ips))]
+            return buildMessage(
+                qid, qsection,
+                authority=[(domain, TYPE_NS, 3600, server) for server in servers],
+                additional=[(server, TYPE_A, 3600, ip) for server, ip in zip(servers, ips)],
+            )
+
+        if labels[0].startswith("nx"):
+            return buildMessage(qid, qsection, RCODE_NXDOMAIN, authoritative=True)
+        if question.type != TYPE_A:
+            return buildMessage(qid, qsection, authoritative=True)
+        address = f"192.0.2.{hash(name) % 254 + 1}"
+        return buildMessage(qid, qsection, answers=[(name, TYPE_A, 300, address)], authoritative=True)
+
+
+class FakeServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, hierarchy, role, tier):
+        self.hierarchy = hierarchy
+        self.role = role
+        self.tier = tier
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        tier = self.tier
+        if tier.loss and random.random() < tier.loss:
+            return
+        response = self.hierarchy.respond(self.role, data)
+        if response is None:
+            return
+        if tier.truncate and random.random() < tier.truncate:
+            # header and question only, so the client has to come back over TCP
+            header = bytearray(response[:12])
+            header[2] |= 0x02
+            struct.pack_into("!HHH", header, 6, 0, 0, 0)
+            response = bytes(header) + data[12:parseMessage(data).skipName(12) + 4]
+        delay = tier.delay()
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+
+def tcp_handler(hierarchy, role, tier):
+    async def handle(reader, writer):
+        try:
+            while True:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+                response = hierarchy.respond(role, await reader.readexactly(length))
+                await asyncio.sleep(tier.delay())
+                writer.write(struct.pack("!H", len(response)) + response)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def run_servers(tiers, auth_count, port, ready):
+    loop = asyncio.get_running_loop()
+    hierarchy = FakeHierarchy(auth_count)
+    roles = [("root", ip) for ip in ROOT_ADDRESSES] + [("tld", ip) for ip in TLD_ADDRESSES]
+    roles += [("auth", ip) for ip in hierarchy.auth]
+
+    for role, ip in roles:
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        udp_socket.bind((ip, port))
+        await loop.create_datagram_endpoint(
+            lambda role=role: FakeServerProtocol(hierarchy, role, tiers[role]), sock=udp_socket
+        )
+        await asyncio.start_server(tcp_handler(hierarchy, role, tiers[role]), ip, port)
+
+    ready.put(None)
+    await asyncio.Event().wait()
+
+
+def serve_fake_hierarchy(tiers, auth_count, port, ready):
+    try:
+        asyncio.run(run_servers(tiers, auth_count, port, ready))
+    except OSError as e:
+        ready.put(str(e))
+
+
+def start_fake_hierarchy(tiers, auth_count=AUTH_SERVERS, port=PORT):
+    """
+    Run the fake servers in a child process so they don't compete with the
+    resolver for its event loop. Returns the process; terminate() it when done.
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=serve_fake_hierarchy, args=(tiers, auth_count, port, ready), daemon=True
+    )
+    process.start()
+    error = ready.get(timeout=30)
+    if error is not None:
+        process.terminate()
+        raise OSError(f"could not start the fake DNS servers: {error}")
+    return process
+
+
+def synthetic_names(count, domains=DOMAINS, nx_ratio=0.0, seed=0):
+    """
+    Yield count distinct host names spread over the given number of
+    second-level domains, some of them nonexistent
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        domain = rng.randrange(domains)
+        host = f"nx{i}" if nx_ratio and rng.random() < nx_ratio else f"h{i}"
+        yield f"{host}.d{domain}.{TLDS[domain % len(TLDS)]}"
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def max_rss_mb():
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+async def resolve_timed(resolver, names, concurrency):
+    """
+    Resolve every name and return (per-name latencies, failures)
+    """
+    latencies = []
+    failures = 0
+    names = iter(names)
+
+    async def worker():
+        nonlocal failures
+        for name in names:
+            start_time = time.perf_counter()
+            answer = await resolver.resolve(name)
+            latencies.append(time.perf_counter() - start_time)
+            if answer is None:
+                failures += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, failures
+
+
+def bench_resolution(count, args):
+    """
+    Resolve count synthetic names against the fake hierarchy with a cold cache
+    """
+    cache = DNSCache(max_entries=args.cache_size)
+    resolver = AsyncResolver(
+        cache=cache,
+        nameservers=NameserverTable(),
+        max_in_flight=args.max_in_flight,
+        timeout=args.timeout,
+        port=args.port,
+        root_servers=ROOT_ADDRESSES,
+    )
+    names = synthetic_names(count, args.domains, args.nx_ratio)
+
+    async def run():
+        async with resolver:
+            return await resolve_timed(resolver, names, args.concurrency)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    latencies, failures = asyncio.run(run())
+    elapsed = time.perf_counter() - start_time
+    peak = None
+    if args.tracemalloc:
+        peak = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "benchmark": "resolve",
+        "names": count,
+        "seconds": round(elapsed, 3),
+        "names_per_second": round(count / elapsed, 1),
+        "queries_per_second": round(resolver.queries_sent / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "failures": failures,
+        "queries": resolver.queries_sent,
+        "timeouts": resolver.timeouts,
+        "tcp_queries": resolver.tcp_queries,
+        "cache_entries": len(cache.entries),
+        "traced_peak_mb": peak,
+        "max_rss_mb": max_rss_mb(),
+    }
+
+
+def sample_packets(auth_count=AUTH_SERVERS):
+    """
+    Responses typical of each step of a resolution, plus a root referral
+    about the size of a real one (13 NS with A and AAAA glue)
+    """
+    hierarchy = FakeHierarchy(auth_count)
+    query = createQuery("www.d42.com", ednsSize=0)
+    packets = {role: hierarchy.respond(role, query) for role in ("root", "tld", "auth")}
+
+    question = query[12:]
+    servers = [f"{letter}.gtld-servers.net" for letter in "abcdefghijklm"]
+    packets["big_referral"] = buildMessage(
+        0, question,
+        authority=[("com", TYPE_NS, 172800, server) for server in servers],
+        additional=[(server, TYPE_A, 172800, f"192.0.2.{i + 1}") for i, server in enumerate(servers)]
+        + [(server, TYPE_AAAA, 172800, f"2001:db8::{i + 1}") for i, server in enumerate(servers)],
+    )
+    return packets
+
+
+def time_ns(function, argument, iterations):
+    start_time = time.perf_counter_ns()
+    for _ in range(iterations):
+        function(argument)
+    return (time.perf_counter_ns() - start_time) / iterations
+
+
+def touch_records(data):
+    # what the resolver does with a response: every name and rdata decoded
+    message = parseMessage(data)
+    for section in (message.answers, message.authority, message.additional):
+        for record in section:
+            record.name
+            record.rdata
+    return message
+
+
+def bench_parser(iterations, auth_count=AUTH_SERVERS):
+    """
+    ns per packet for the wire-format code on the resolver's hot path
+    """
+    rows = []
+    for kind, packet in sample_packets(auth_count).items():
+        rows.append({
+            "benchmark": "parse",
+            "packet": kind,
+            "bytes": len(packet),
+            "parseMessage_ns": round(time_ns(parseMessage, packet, iterations)),
+            "parse_all_ns": round(time_ns(touch_records, packet, iterations)),
+            "decodeResponse_ns": round(time_ns(decodeResponse, packet, iterations)),
+        })
+
+    name = "www.d42.com"
+    rows.append({
+        "benchmark": "query",
+        "createQuery_ns": round(time_ns(createQuery, name, iterations)),
+        "template_build_ns": round(time_ns(query_templates.build, name, iterations)),
+    })
+    return rows
+
+
+def print_row(row, as_json):
+    if as_json:
+        print(json.dumps(row))
+    else:
+        print("  ".join(f"{key}={value}" for key, value in row.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the resolver against a local fake root/TLD/authoritative hierarchy"
+    )
+    parser.add_argument("--names", type=int, nargs="+", default=list(SIZES),
+                        help="synthetic name list sizes to resolve, e.g. 1000 100000 1000000")
+    parser.add_argument("--domains", type=int, default=DOMAINS, help="second-level domains the names are spread over")
+    parser.add_argument("--nx-ratio", type=float, default=0.0, help="fraction of names that don't exist")
+    for tier in ("root", "tld", "auth"):
+        parser.add_argument(f"--{tier}", type=Tier.parse, default=Tier(), metavar="SPEC",
+                            help="e.g. latency=5,jitter=2,loss=0.01,truncate=0.1 (ms and fractions)")
+    parser.add_argument("--auth-servers", type=int, default=AUTH_SERVERS)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT)
+    parser.add_argument("--timeout", type=float, default=TIMEOUT)
+    parser.add_argument("--cache-size", type=int, default=100000)
+    parser.add_argument("--parser-iterations", type=int, default=PARSER_ITERATIONS)
+    parser.add_argument("--skip-parser", action="store_true")
+    parser.add_argument("--skip-resolve", action="store_true")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also report peak traced Python memory (slows resolution down a lot)")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per result")
+    args = parser.parse_args(argv)
+
+    if not args.skip_parser:
+        for row in bench_parser(args.parser_iterations, args.auth_servers):
+            print_row(row, args.json)
+
+    if args.skip_resolve:
+        return
+
+    tiers = {"root": args.root, "tld": args.tld, "auth": args.auth}
+    servers = start_fake_hierarchy(tiers, args.auth_servers, args.port)
+    try:
+        for count in args.names:
+            row = bench_resolution(count, args)
+            row.update({tier: str(settings) for tier, settings in tiers.items()})
+            print_row(row, args.json)
+    finally:
+        servers.terminate()
+        servers.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import time
+from collections import OrderedDict
+
+# upper bound on how long anything stays cached, regardless of the record TTL
+MAX_TTL = 86400
+# TTL used for NXDOMAIN/NODATA answers that come without an SOA to take it from
+NEGATIVE_TTL = 300
+# upper bound on a negative answer's TTL, RFC 2308 section 5 suggests 1-3 hours
+MAX_NEGATIVE_TTL = 10800
+MAX_ENTRIES = 10000
+
+
+def normalize_name(name):
+    """
+    Lower-case a domain name and strip the trailing root dot
+    """
+    if isinstance(name, bytes):
+        name = name.decode("utf-8")
+    return name.lower().rstrip(".")
+
+
+def in_zone(name, zone):
+    """
+    True if name is zone itself or somewhere below it ("" is the root)
+    """
+    return not zone or name == zone or name.endswith("." + zone)
+
+
+class DNSCache:
+    """
+    In-process resolver cache for positive answers, negative answers and
+    delegation points (zone -> NS names + glue), expired by TTL and bounded
+    in size with LRU eviction
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires, value = entry
+        if expires <= self.clock():
+            del self.entries[key]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl):
+        ttl = min(ttl, MAX_TTL)
+        if ttl <= 0:
+            return
+
+        self.entries[key] = (self.clock() + ttl, value)
+        self.entries.move_to_end(key)
+
+        # evict least recently used entries
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_answer(self, name, typeDNS=1):
+        """
+        Return cached answer records, [] for a cached negative answer,
+        or None on a miss
+        """
+        return self.get(("answer", normalize_name(name), typeDNS))
+
+    def answer_ttl(self, name, typeDNS=1):
+        """
+        Whole seconds until the cached answer for name expires, or None if
+        it isn't cached
+        """
+        entry = self.entries.get(("answer", normalize_name(name), typeDNS))
+        if entry is None:
+            return None
+        return max(0, int(entry[0] - self.clock()))
+
+    def put_answer(self, name, answers, typeDNS=1):
+        if not answers:
+            return
+        ttl = min(record["ttl"] for record in answers)
+        self.put(("answer", normalize_name(name), typeDNS), answers, ttl)
+
+    def put_negative(self, name, typeDNS=1, ttl=None, nxdomain=False):
+        """
+        Cache NXDOMAIN/NODATA for ttl seconds, the response's SOA-derived
+        negative TTL, or NEGATIVE_TTL if it had none
+        """
+        ttl = NEGATIVE_TTL if ttl is None else min(ttl, MAX_NEGATIVE_TTL)
+        self.put(("answer", normalize_name(name), typeDNS), [], ttl)
+        # NXDOMAIN covers every type, NODATA only the one we asked for
+        if nxdomain:
+            self.put(("nxdomain", normalize_name(name)), True, ttl)
+
+    def is_nxdomain(self, name):
+        return bool(self.get(("nxdomain", normalize_name(name))))
+
+    def put_delegation(self, zone, ns_records, glue):
+        """
+        Remember the NS set and the glue addresses for a zone cut, and
+        return it with the glue limited to the zone's own nameservers
+        """
+        if not ns_records:
+            return None
+
+        ns_names = {normalize_name(record["ns"]) for record in ns_records}
+        glue = [record for record in glue if normalize_name(record["name"]) in ns_names]
+
+        ttls = [record.get("ttl", NEGATIVE_TTL) for record in ns_records]
+        ttls += [record["ttl"] for record in glue]
+
+        delegation = {"ns": sorted(ns_names), "ipv4": glue}
+        self.put(("zone", normalize_name(zone)), delegation, min(ttls))
+        return delegation
+
+    def find_delegation(self, name):
+        """
+        Return (zone, delegation) for the closest cached zone cut enclosing
+        name, or (None, None) if we have to start from the root
+        """
+        labels = normalize_name(name).split(".")
+        for i in range(len(labels)):
+            zone = ".".join(labels[i:])
+            delegation = self.get(("zone", zone))
+            if delegation and delegation["ipv4"]:
+                return zone, delegation
+        return None, None
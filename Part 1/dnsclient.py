@@ -1,9 +1,36 @@
+import os
 import socket
 import random
+import select
 import struct
-import io
+import sys
+import threading
 import time
 
+from dnscache import DNSCache, in_zone, normalize_name
+from dnsmessage import NAME_TYPES, TYPE_A, TYPE_AAAA, TYPE_CNAME, TYPE_NS, TYPE_OPT, encodeName, isTruncated, parseMessage
+from dnstcp import TCPConnections
+from dnsservers import NameserverTable
+from httppool import ConnectionPool, interleave_addresses
+from timing import dns_phase, timings
+
+# limits that keep a broken or malicious delegation from looping forever
+MAX_REFERRALS = 16
+MAX_CNAME_CHAIN = 8
+MAX_GLUELESS_DEPTH = 4
+
+# UDP payload size we advertise with EDNS0, 1232 avoids IP fragmentation on
+# almost every path, 4096 is the traditional default, 0 turns EDNS0 off
+EDNS_BUFFER_SIZE = 1232
+# the rcodes that are an answer about the name: NOERROR (including NODATA)
+# and NXDOMAIN. Anything else (SERVFAIL, REFUSED, ...) is the server failing.
+ANSWER_RCODES = (0, 3)
+# anything bigger than this doesn't fit in a UDP datagram anyway
+MAX_UDP_SIZE = 65535
+MAX_QUERY_TEMPLATES = 65536
+# how long AAAA may lag behind A before connecting without it (RFC 8305 section 3)
+RESOLUTION_DELAY = 0.05
+
 # Existing rootServers dictionary remains unchanged...
 rootServers = {
     "a.root-servers.net": "198.41.0.4",
@@ -21,202 +48,196 @@ rootServers = {
     "m.root-servers.net": "202.12.27.33",
 }
 
-def createQuery(hostName, typeDNS=1, classDNS=1):
+# shared by every lookup in this process so repeated names and zones skip the root
+dns_cache = DNSCache()
+# smoothed RTT and failure score per nameserver IP, see nameservers.print_report()
+nameservers = NameserverTable()
+# kept open between queries so a truncated answer costs one more round trip
+tcp_connections = TCPConnections()
+# kept-alive HTTP connections keyed by (ip, port, Host)
+http_pool = ConnectionPool()
+
+def encodeQuery(hostName, typeDNS=1, classDNS=1, ednsSize=EDNS_BUFFER_SIZE):
+    """
+    Build the wire format of a query with a zero ID
+    """
     # Header
-    id = random.randint(0, 65535)
     flags = 0x0100
     numQuestions = 1
     numAnswers = 0
     numAuthorities = 0
-    numAdditionals = 0
+    numAdditionals = 1 if ednsSize else 0
 
     header = struct.pack(
-        "!HHHHHH", id, flags, numQuestions, numAnswers, numAuthorities, numAdditionals
+        "!HHHHHH", 0, flags, numQuestions, numAnswers, numAuthorities, numAdditionals
     )
 
     # Question
-    encodedName = b""
-    for part in hostName.encode("utf-8").split(b"."):
-        encodedName += bytes([len(part)]) + part
-    encodedName += b"\x00"
+    question = encodeName(hostName) + struct.pack("!HH", typeDNS, classDNS)
 
-    question = encodedName + struct.pack("!HH", typeDNS, classDNS)
+    # EDNS0 OPT pseudo-record advertising our UDP buffer size (RFC 6891)
+    if ednsSize:
+        question += b"\x00" + struct.pack("!HHIH", TYPE_OPT, ednsSize, 0, 0)
 
     return header + question
 
+class QueryTemplates:
+    """
+    Encoded queries cached by question, so building a query for a name we've
+    asked about before only means patching a new ID into its buffer
+    """
 
-def decodeName(response):
-    parts = []
-    try:
-        while True:
-            length = response.read(1)
-            if not length:  # Check for EOF
-                break
-            length = length[0]
-            if length == 0:
-                break
-
-            if length & 0xC0:  # Compression pointer
-                pointer_bytes = bytes([length & 0x3F]) + response.read(1)
-                pointer = struct.unpack("!H", pointer_bytes)[0]
-                current_pos = response.tell()
-                response.seek(pointer)
-                result = decodeName(response)
-                response.seek(current_pos)
-                parts.append(result.decode("utf-8"))
-                break
-            else:
-                part = response.read(length)
-                if not part:  # Check for EOF
-                    break
-                parts.append(part.decode("utf-8"))
-
-    except Exception as e:
-        print(f"Error in decodeName: {e}")
-        return b""
-
-    return ".".join(parts).encode("utf-8")
+    def __init__(self, max_entries=MAX_QUERY_TEMPLATES):
+        self.max_entries = max_entries
+        self.templates = {}
+
+    def build(self, hostName, typeDNS=1, classDNS=1, ednsSize=EDNS_BUFFER_SIZE, id=None):
+        """
+        Return the query with a fresh (or the given) ID. The buffer is shared,
+        so send or copy it before building another query for the same name.
+        """
+        key = (hostName, typeDNS, classDNS, ednsSize)
+        template = self.templates.get(key)
+        if template is None:
+            if len(self.templates) >= self.max_entries:
+                # dicts keep insertion order, so this drops the oldest template
+                del self.templates[next(iter(self.templates))]
+            template = self.templates[key] = bytearray(encodeQuery(hostName, typeDNS, classDNS, ednsSize))
+
+        struct.pack_into("!H", template, 0, random.randint(0, 65535) if id is None else id)
+        return template
+
+def createQuery(hostName, typeDNS=1, classDNS=1, ednsSize=EDNS_BUFFER_SIZE):
+    # the A and AAAA lookups run in threads, which mustn't patch the same template at once
+    with template_lock:
+        return bytes(query_templates.build(hostName, typeDNS, classDNS, ednsSize))
+
+query_templates = QueryTemplates()
+template_lock = threading.Lock()
+
+def answerRecord(record):
+    # A/AAAA as text, anything else as the raw rdata bytes
+    ip = record.rdata if record.type in (TYPE_A, TYPE_AAAA) else bytes(record.raw)
+    answer = {"name": record.name, "type": record.type, "class": record.rclass, "ttl": record.ttl, "ip": ip}
+    # CNAME/NS/PTR also get their decoded target name
+    if record.type in NAME_TYPES:
+        answer["target"] = record.rdata
+    return answer
+
+def nsRecord(record):
+    return {"domain": record.name, "ns": record.rdata, "ttl": record.ttl}
+
+def glueRecord(record):
+    return {"name": record.name, "type": record.type, "ttl": record.ttl, "ip": record.rdata}
 
 def decodeResponse(responseData):
-    response = io.BytesIO(responseData)
+    """
+    Decode a DNS response into the header, question, answers, NS records and
+    the A/AAAA glue from the additional section
+    """
+    message = parseMessage(responseData)
 
-    # Header
-    id, flags, numQuestions, numAnswers, numAuthorities, numAdditionals = struct.unpack(
-        "!HHHHHH", response.read(12)
-    )
+    header = message.header.as_dict()
 
-    header = {
-        "id": id,
-        "flags": flags,
-        "numQuestions": numQuestions,
-        "numAnswers": numAnswers,
-        "numAuthorities": numAuthorities,
-        "numAdditionals": numAdditionals,
-    }
+    question = {}
+    if message.question is not None:
+        question = {
+            "name": message.question.name.encode("utf-8"),
+            "type": message.question.type,
+            "class": message.question.rclass,
+        }
 
-    # Question
-    name = decodeName(response)
-    typeDNS, classDNS = struct.unpack("!HH", response.read(4))
+    answers = [answerRecord(record) for record in message.answers]
+    auth_records = [nsRecord(record) for record in message.authority if record.type == TYPE_NS]
+    ipv4 = [glueRecord(record) for record in message.additional if record.type == TYPE_A]
+    ipv6 = [glueRecord(record) for record in message.additional if record.type == TYPE_AAAA]
 
-    question = {"name": name, "type": typeDNS, "class": classDNS}
+    return header, question, answers, auth_records, ipv4, ipv6
 
-    # Answer
-    answers = []
-    for _ in range(numAnswers):
-        try:
-            answer_name = decodeName(response)
-            record_data = response.read(10)
-            if len(record_data) < 10:
-                break
-
-            rType, rClass, ttl, rDataLength = struct.unpack("!HHIH", record_data)
-            rData = response.read(rDataLength)
-            # A Record
-            if rType == 1:
-                rData = ".".join(str(b) for b in rData)
-            # AAAA Record
-            elif rType == 28:
-                ipv6_parts = [rData[i : i + 2].hex() for i in range(0, 16, 2)]
-                rData = ":".join(ipv6_parts)
-
-            answers.append(
-                {
-                    "name": answer_name.decode("utf-8"),
-                    "type": rType,
-                    "class": rClass,
-                    "ttl": ttl,
-                    "ip": rData,
-                }
-            )
-        except Exception as e:
-            print(f"Error parsing answer: {e}")
-            break
-
-    # Authority
-    auth_records = []
-    for _ in range(numAuthorities):
-        try:
-            auth_name = decodeName(response)
-            auth_data = response.read(10)
-            if len(auth_data) < 10:
-                break
-
-            rType, rClass, ttl, rDataLength = struct.unpack("!HHIH", auth_data)
-            # NS Record
-            if rType == 2:
-                tld_name = decodeName(response)
-                auth_records.append(
-                    {
-                        "domain": auth_name.decode("utf-8"),
-                        "ns": tld_name.decode("utf-8"),
-                    }
-                )
-            else:
-                response.read(rDataLength)
-        except Exception as e:
-            print(f"Error parsing authority: {e}")
-            break
-
-    # Additional
-    ipv4 = []
-    ipv6 = []
-    for _ in range(numAdditionals):
-        try:
-            add_name = decodeName(response)
-            add_data = response.read(10)
-            if len(add_data) < 10:
-                break
-
-            rType, rClass, ttl, rDataLength = struct.unpack("!HHIH", add_data)
-            record_info = {"name": add_name.decode("utf-8"), "type": rType, "ttl": ttl}
-
-            # A Record (IPv4)
-            if rType == 1:
-                ip_bytes = response.read(rDataLength)
-                record_info["ip"] = ".".join(str(b) for b in ip_bytes)
-                ipv4.append(record_info)
-            # AAAA Record (IPv6)
-            elif rType == 28:
-                ip_bytes = response.read(rDataLength)
-                ipv6_parts = [ip_bytes[i : i + 2].hex() for i in range(0, 16, 2)]
-                record_info["ip"] = ":".join(ipv6_parts)
-                ipv6.append(record_info)
-            else:
-                response.read(rDataLength)
-
-        except Exception as e:
-            print(f"Error parsing additional record: {e}")
-            break
+def wait_for_response(client_socket, query_id, sent, until):
+    """
+    Wait until the deadline for a response to our query from one of the
+    servers we sent it to, ignoring anything else that arrives
+    """
+    while True:
+        remaining = until - time.perf_counter()
+        if remaining <= 0:
+            return None, None
 
-    return header, question, answers, auth_records, ipv4, ipv6
+        readable, _, _ = select.select([client_socket], [], [], remaining)
+        if not readable:
+            return None, None
+
+        response, addr = client_socket.recvfrom(MAX_UDP_SIZE)
+        if addr[0] in sent and response[:2] == query_id:
+            return response, addr[0]
 
-def query_dns_server(client_socket, request, servers, server_type=""):
+def query_dns_server(client_socket, request, servers, server_type="", table=None):
     """
-    Query DNS servers and return the first successful response
+    Query DNS servers fastest first and return the first successful response.
+    If a server hasn't answered within its expected RTT the next one is
+    asked as well, and whichever answers first wins. A server answering
+    with an error rcode is moved on from at once; if they all do, the last
+    such response is returned.
     """
-    response = None
-    responding_server = None
+    table = nameservers if table is None else table
+    timeout = client_socket.gettimeout() or 10
 
+    by_ip = {}
     for server in servers:
-        try:
-            start_time = time.time()
-            
-            server_ip = servers[server] if isinstance(servers, dict) else server["ip"]
+        server_ip = servers[server] if isinstance(servers, dict) else server["ip"]
+        by_ip[server_ip] = server
+
+    pending = table.order(by_ip)
+    sent = {}
+    deadline = 0
+    failed = None
+
+    while pending or time.perf_counter() < deadline:
+        if pending:
+            server_ip = pending.pop(0)
+            start_time = time.perf_counter()
             client_socket.sendto(request, (server_ip, 53))
-            
-            response, addr = client_socket.recvfrom(1024)
-            
-            if response:
-                end_time = time.time()
-                rtt = round(end_time - start_time, 5)
-                print(f"The RTT between this machine and the server was {rtt} seconds")
-                responding_server = server
-                break
-                
-        except socket.timeout:
-            print(f"No response from: {server}")
-    
-    return response, responding_server
+            table.sent(server_ip)
+            sent[server_ip] = start_time
+            deadline = start_time + timeout
+            until = start_time + table.hedge_delay(server_ip) if pending else deadline
+        else:
+            until = deadline
+
+        response, server_ip = wait_for_response(client_socket, request[:2], sent, until)
+
+        if response:
+            rtt = time.perf_counter() - sent[server_ip]
+            table.response(server_ip, rtt)
+            print(f"The RTT between this machine and {server_ip} was {round(rtt, 5)} seconds")
+
+            rcode = response[3] & 0x0F
+            if rcode not in ANSWER_RCODES:
+                table.error(server_ip)
+                print(f"{by_ip[server_ip]} answered with rcode {rcode}, trying the next server")
+                failed = response, by_ip[server_ip]
+                del sent[server_ip]
+                if not pending and not sent:
+                    break
+                continue
+
+            if isTruncated(response):
+                print(f"Response from {server_ip} was truncated, retrying over TCP")
+                # a truncated referral is still better than nothing if TCP fails
+                response = tcp_connections.query(server_ip, request) or response
+
+            return response, by_ip[server_ip]
+
+        # slower than expected, hedge. It's only a timeout once the deadline has
+        # passed: until then its answer is as good as anyone's and its RTT counts
+        if pending and sent:
+            print(f"No response yet from: {by_ip[list(sent)[-1]]}")
+
+    for server_ip in sent:
+        table.timeout(server_ip)
+        print(f"No response from: {by_ip[server_ip]}")
+    return failed or (None, None)
 
 def process_dns_response(response, server_type):
     """
@@ -224,7 +245,7 @@ def process_dns_response(response, server_type):
     """
     if not response:
         print(f"No response from any {server_type} server")
-        return None, None, None
+        return None, None, None, None
         
     header, question, answer, ns_records, ipv4, ipv6 = decodeResponse(response)
     
@@ -235,105 +256,278 @@ def process_dns_response(response, server_type):
     print(f"Name Servers: {ns_records}")
     print(f"Additional: {ipv4} {ipv6}")
     
-    return answer, ns_records, ipv4
+    return header, answer, ns_records, ipv4
 
-def make_http_request(answer):
+def make_http_request(answer, host_name=None, path="/"):
     """
-    Make HTTP request to the resolved IP address
+    Make HTTP request to the resolved IP addresses, racing connections to
+    the IPv6 and IPv4 ones
     """
     if not answer:
         return
-        
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
-        for host in answer:
-            try:
-                tcp_socket.connect((host["ip"], 80))
-                start_time = time.time()
-
-                http_request = (
-                    f"GET / HTTP/1.1\r\n"
-                    f"Host: {host['name']}\r\n"
-                    "Connection: close\r\n"
-                    "User-Agent: Custom-Client/1.0\r\n"
-                    "Accept: */*\r\n"
-                    "\r\n"
-                )
-
-                tcp_socket.sendall(http_request.encode())
-                
-                response = receive_http_response(tcp_socket)
-                if response:
-                    end_time = time.time()
-                    process_http_response(response, host, start_time, end_time)
-                    break
-
-            except socket.timeout:
-                print(f"No response from: {host}")
-            except Exception as e:
-                print(f"Error connecting to {host['name']}: {e}")
 
-def receive_http_response(tcp_socket):
-    """
-    Receive and concatenate HTTP response data
-    """
-    response = b""
-    while True:
-        data = tcp_socket.recv(4096)
-        if not data:
-            break
-        response += data
-    return response
+    # the Host header must name the site, not the end of a CNAME chain
+    host = {"name": host_name or answer[0]["name"]}
+    addresses = interleave_addresses(
+        [record["ip"] for record in answer if record["type"] == TYPE_AAAA],
+        [record["ip"] for record in answer if record["type"] == TYPE_A],
+    )
+    try:
+        start_time = time.time()
+        # the body goes straight to a temporary file as it arrives, byte for
+        # byte, and only replaces output2.html once the whole response is in
+        try:
+            with open("output2.html.part", "wb") as output:
+                # a kept-alive connection from an earlier request is reused,
+                # otherwise whichever address connects first wins
+                response = http_pool.request(addresses, host["name"], path, output)
+        except BaseException:
+            os.remove("output2.html.part")
+            raise
+        os.replace("output2.html.part", "output2.html")
+        end_time = time.time()
+        host["ip"] = response.address
+        process_http_response(response, host, start_time, end_time)
+
+    except socket.timeout:
+        print(f"No response from: {host['name']} ({', '.join(addresses)})")
+    except Exception as e:
+        print(f"Error connecting to {host['name']}: {e}")
 
 def process_http_response(response, host, start_time, end_time):
     """
-    Process HTTP response and save to file
+    Report on an HTTP response whose body has been saved
     """
-    response = response.decode("utf-8")
-    status, header, body = response.partition("\r\n\r\n")
-    
-    with open("output2.html", "w", encoding="utf-8") as f:
-        f.write(body)
-    
     rtt = round(end_time - start_time, 5)
-    print(status)
+    print(f"Connected to {host['ip']}")
+    print(response.status_line)
+    print(f"Saved {response.body_length} bytes of body to output2.html")
     print(f"The RTT between this machine and {host['name']}'s server was {rtt} seconds")
 
-def resolve_domain(site_name):
+def follow_cnames(name, answers, typeDNS=1):
+    """
+    Walk the CNAME chain starting at name through answers. Returns the name
+    at the end of the chain and its typeDNS records, or (None, None) if the
+    chain loops back on itself.
+    """
+    cnames = {
+        normalize_name(record["name"]): normalize_name(record["target"])
+        for record in answers
+        if record["type"] == TYPE_CNAME
+    }
+
+    seen = {name}
+    while name in cnames:
+        name = cnames[name]
+        if name in seen:
+            return None, None
+        seen.add(name)
+
+    return name, [record for record in answers if record["type"] == typeDNS and normalize_name(record["name"]) == name]
+
+def glue_from_answers(ns_name, answers):
+    """
+    Turn the A records from resolving a glueless NS name into glue records
+    for that name
+    """
+    return [
+        {"name": ns_name, "type": TYPE_A, "ttl": record["ttl"], "ip": record["ip"]}
+        for record in answers or []
+        if record["type"] == TYPE_A
+    ]
+
+def resolve_glueless(ns_records, client_socket, cache, parents):
+    """
+    Resolve the addresses of a referral's nameservers when it came without
+    glue, stopping at the first one that resolves
+    """
+    if len(parents) > MAX_GLUELESS_DEPTH:
+        return []
+
+    for record in ns_records:
+        ns_name = normalize_name(record["ns"])
+        # an NS that needs itself (or one of our parents) to resolve can't help
+        if ns_name in parents:
+            continue
+        print(f"Resolving glueless nameserver {ns_name}")
+        glue = glue_from_answers(ns_name, lookup_domain(ns_name, client_socket, cache, parents=parents))
+        if glue:
+            return glue
+    return []
+
+def iterate_domain(name, client_socket, cache, typeDNS=1, parents=()):
+    """
+    Follow referrals for name from the closest cached delegation down to an
+    authoritative answer. Returns the answer records, [] for NXDOMAIN/NODATA
+    or None if resolution failed.
+    """
+    cached = cache.get_answer(name, typeDNS)
+    if cached is not None:
+        print(f"Cache hit for {name}: {cached}")
+        return cached
+
+    zone, delegation = cache.find_delegation(name)
+    if delegation:
+        print(f"Starting from cached delegation for {zone}: {delegation['ns']}")
+        servers, server_type = delegation["ipv4"], zone
+    else:
+        zone, servers, server_type = "", rootServers, "Root"
+
+    request = createQuery(name, typeDNS)
+
+    for _ in range(MAX_REFERRALS):
+        with timings.span(dns_phase(zone), name=name, zone=zone) as span:
+            response, server = query_dns_server(client_socket, request, servers, server_type)
+            span["ok"] = response is not None
+            span["server"] = server["ip"] if isinstance(server, dict) else server
+        header, answer, ns_records, ipv4 = process_dns_response(response, server_type)
+
+        if header is None:
+            return None
+
+        # every server failed, which says nothing about the name so isn't cached
+        rcode = header["flags"] & 0x000F
+        if rcode not in ANSWER_RCODES:
+            print(f"No usable response from any {server_type} server (rcode {rcode})")
+            return None
+
+        if answer:
+            cache.put_answer(name, answer, typeDNS)
+            return answer
+
+        # NXDOMAIN, or NODATA without a referral to follow
+        if rcode == 3 or not ns_records:
+            cache.put_negative(name, typeDNS, parseMessage(response).negativeTTL(), nxdomain=rcode == 3)
+            return []
+
+        referral = normalize_name(ns_records[0]["domain"])
+        if referral == zone or not in_zone(referral, zone) or not in_zone(name, referral):
+            print(f"Lame referral to {referral} from {server_type}")
+            return None
+
+        delegation = cache.put_delegation(referral, ns_records, ipv4)
+        if not delegation["ipv4"]:
+            glue = resolve_glueless(ns_records, client_socket, cache, parents + (name,))
+            delegation = cache.put_delegation(referral, ns_records, glue)
+        if not delegation["ipv4"]:
+            return None
+
+        zone, servers, server_type = referral, delegation["ipv4"], referral
+
+    return None
+
+def lookup_domain(site_name, client_socket, cache=None, typeDNS=1, parents=()):
+    """
+    Resolve site_name to its typeDNS records, chasing CNAMEs. Returns the
+    whole answer chain (CNAMEs included) or None.
+    """
+    cache = dns_cache if cache is None else cache
+    site_name = normalize_name(site_name)
+
+    name = site_name
+    chain = []
+    seen = set()
+
+    for _ in range(MAX_CNAME_CHAIN):
+        if name in seen:
+            print(f"CNAME loop at {name}")
+            return None
+        seen.add(name)
+
+        answers = iterate_domain(name, client_socket, cache, typeDNS, parents)
+        if not answers:
+            return None
+        chain += [record for record in answers if record not in chain]
+
+        target, records = follow_cnames(name, answers, typeDNS)
+        if target is None:
+            print(f"CNAME loop at {name}")
+            return None
+        if records:
+            if name != site_name:
+                cache.put_answer(site_name, chain, typeDNS)
+            return chain
+
+        print(f"Following CNAME {name} -> {target}")
+        name = target
+
+    return None
+
+class LockedCache:
+    """
+    Lets threads share a DNSCache (or PersistentDNSCache): each method call
+    holds a lock, so a find_delegation doesn't see half of a put
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        method = getattr(self.cache, name)
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                return method(*args, **kwargs)
+
+        return locked
+
+def resolve_domain(site_name, cache=None):
     """
     Main domain resolution function
     """
-    request = createQuery(site_name)
-    
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
-        client_socket.settimeout(10)
-        
-        # Query root servers
-        root_response, _ = query_dns_server(client_socket, request, rootServers, "Root")
-        _, _, root_ipv4 = process_dns_response(root_response, "Root")
-        
-        if not root_ipv4:
-            return
-            
-        # Query TLD servers
-        tld_response, _ = query_dns_server(client_socket, request, root_ipv4, "TLD")
-        _, _, tld_ipv4 = process_dns_response(tld_response, "TLD")
-        
-        if not tld_ipv4:
-            return
-            
-        # Query authoritative servers
-        auth_response, _ = query_dns_server(client_socket, request, tld_ipv4, "Authoritative")
-        auth_answer, _, _ = process_dns_response(auth_response, "Authoritative")
-        
-        if not auth_answer:
-            return
-            
-        # Make HTTP request to resolved IP
-        make_http_request(auth_answer)
+    cache = LockedCache(dns_cache if cache is None else cache)
+    results = {}
+
+    # A and AAAA are looked up at the same time, each in its own thread with its own socket
+    def lookup(typeDNS):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
+            client_socket.settimeout(10)
+            results[typeDNS] = lookup_domain(site_name, client_socket, cache, typeDNS)
+
+    threads = {typeDNS: threading.Thread(target=lookup, args=(typeDNS,)) for typeDNS in (TYPE_A, TYPE_AAAA)}
+    for thread in threads.values():
+        thread.start()
+    threads[TYPE_A].join()
+    # with no IPv4 to fall back on, wait for AAAA in full
+    threads[TYPE_AAAA].join(RESOLUTION_DELAY if results.get(TYPE_A) else None)
+
+    ipv4 = [record for record in results.get(TYPE_A) or () if record["type"] == TYPE_A]
+    ipv6 = [record for record in results.get(TYPE_AAAA) or () if record["type"] == TYPE_AAAA]
+    print(f"IPv4: {[record['ip'] for record in ipv4]}")
+    print(f"IPv6: {[record['ip'] for record in ipv6]}")
+
+    # Make HTTP request to resolved IPs, skipping the CNAMEs on the way there
+    make_http_request(ipv6 + ipv4, site_name)
+
+    # an AAAA lookup we went on without still fills the cache, it has to end
+    # here so its trace doesn't run into the next site's
+    threads[TYPE_AAAA].join()
 
 def main():
+    # "python dnsclient.py serve [--port N]" runs the local DNS server instead
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        import dnsserver
+        dnsserver.main(sys.argv[2:])
+        return
+
+    # point DNS_CACHE_FILE at an SQLite file to keep the cache between runs
+    cache = None
+    if os.environ.get("DNS_CACHE_FILE"):
+        from dnsdiskcache import PersistentDNSCache
+        cache = PersistentDNSCache(os.environ["DNS_CACHE_FILE"])
+    # and DNS_TIMING_FILE at a file to get a JSON line per timed phase
+    if os.environ.get("DNS_TIMING_FILE"):
+        timings.open(os.environ["DNS_TIMING_FILE"])
+
     site_name = input("What site do you want the IP for: ")
-    resolve_domain(site_name)
+    resolve_domain(site_name, cache)
+
+    print("\nNameserver stats:")
+    nameservers.print_report()
+    print("\nLatency by phase:")
+    timings.print_summary()
+    timings.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
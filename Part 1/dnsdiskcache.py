@@ -0,0 +1,109 @@
+import atexit
+import json
+import sqlite3
+import time
+
+from dnscache import MAX_ENTRIES, MAX_TTL, DNSCache
+
+# write-behind: new records are written in one transaction once there are
+# this many of them or this many seconds have passed
+COMMIT_EVERY = 200
+COMMIT_INTERVAL = 1.0
+# how long a writer waits for another process's transaction before giving up
+BUSY_TIMEOUT = 30.0
+
+
+def encode_value(value):
+    # answer records keep non-address rdata as raw bytes, which JSON can't hold
+    return json.dumps(value, separators=(",", ":"), default=lambda data: {"$bytes": data.hex()})
+
+
+def decode_value(text):
+    return json.loads(text, object_hook=lambda obj: bytes.fromhex(obj["$bytes"]) if "$bytes" in obj else obj)
+
+
+class PersistentDNSCache(DNSCache):
+    """
+    DNSCache backed by an SQLite file so answers and delegations survive
+    between runs. Records are stored with absolute expiry times, and the
+    in-memory LRU stays in front of the file for speed. Any number of
+    processes can share one file: SQLite's WAL mode lets readers and a
+    writer work at the same time.
+    """
+
+    def __init__(self, path, max_entries=MAX_ENTRIES, clock=time.monotonic):
+        super().__init__(max_entries, clock)
+        self.path = path
+        self.disk_hits = 0
+        self.unsaved = []
+        self.last_commit = time.monotonic()
+
+        # dnsclient's A and AAAA threads share the cache behind a lock
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        self.db.execute("DELETE FROM records WHERE expires <= ?", (time.time(),))
+
+        atexit.register(self.close)
+
+    def get(self, key):
+        value = super().get(key)
+        if value is not None or self.db is None:
+            return value
+
+        row = self.db.execute(
+            "SELECT value, expires FROM records WHERE key = ?", (json.dumps(key),)
+        ).fetchone()
+        if row is None:
+            return None
+
+        remaining = row[1] - time.time()
+        if remaining <= 0:
+            return None
+
+        # another run (or another process) already resolved this
+        value = decode_value(row[0])
+        super().put(key, value, remaining)
+        self.misses -= 1
+        self.hits += 1
+        self.disk_hits += 1
+        return value
+
+    def put(self, key, value, ttl):
+        ttl = min(ttl, MAX_TTL)
+        if ttl <= 0:
+            return
+
+        super().put(key, value, ttl)
+        if self.db is None:
+            return
+
+        self.unsaved.append((json.dumps(key), encode_value(value), time.time() + ttl))
+        if len(self.unsaved) >= COMMIT_EVERY or time.monotonic() - self.last_commit >= COMMIT_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """
+        Write pending records so other processes can see them. The write
+        lock is only held for this one short transaction.
+        """
+        if self.db is None or not self.unsaved:
+            return
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO records (key, value, expires) VALUES (?, ?, ?)", self.unsaved
+            )
+        self.unsaved = []
+        self.last_commit = time.monotonic()
+
+    def close(self):
+        if self.db is None:
+            return
+        self.flush()
+        self.db.close()
+        self.db = None
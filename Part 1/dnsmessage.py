@@ -0,0 +1,265 @@
+import socket
+import struct
+
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_PTR = 12
+TYPE_AAAA = 28
+TYPE_OPT = 41
+
+# record types whose rdata is a single (possibly compressed) domain name
+NAME_TYPES = (TYPE_NS, TYPE_CNAME, TYPE_PTR)
+
+HEADER = struct.Struct("!HHHHHH")
+QUESTION = struct.Struct("!HH")
+RECORD = struct.Struct("!HHIH")
+
+
+def formatIPv4(rdata):
+    return socket.inet_ntoa(rdata)
+
+
+def formatIPv6(rdata):
+    # same uncompressed hex-pair format decodeResponse has always produced
+    digits = bytes(rdata).hex()
+    return ":".join([digits[i : i + 4] for i in range(0, 32, 4)])
+
+
+def encodeName(name):
+    """
+    Encode a domain name as uncompressed wire-format labels
+    """
+    parts = [bytes([len(part)]) + part for part in name.encode("utf-8").split(b".") if part]
+    return b"".join(parts) + b"\x00"
+
+
+def isTruncated(data):
+    """
+    Check the TC bit without parsing the rest of the message
+    """
+    return len(data) > 2 and bool(data[2] & 0x02)
+
+
+class Header:
+    __slots__ = ("id", "flags", "numQuestions", "numAnswers", "numAuthorities", "numAdditionals")
+
+    def __init__(self, id, flags, numQuestions, numAnswers, numAuthorities, numAdditionals):
+        self.id = id
+        self.flags = flags
+        self.numQuestions = numQuestions
+        self.numAnswers = numAnswers
+        self.numAuthorities = numAuthorities
+        self.numAdditionals = numAdditionals
+
+    @property
+    def rcode(self):
+        return self.flags & 0x000F
+
+    @property
+    def truncated(self):
+        return bool(self.flags & 0x0200)
+
+    def as_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class Question:
+    __slots__ = ("name", "type", "rclass")
+
+    def __init__(self, name, type, rclass):
+        self.name = name
+        self.type = type
+        self.rclass = rclass
+
+
+class Record:
+    """
+    A resource record whose owner name and rdata are only decoded when
+    first accessed
+    """
+
+    __slots__ = ("message", "nameOffset", "type", "rclass", "ttl", "rdataOffset", "rdataLength", "_rdata")
+
+    def __init__(self, message, nameOffset, type, rclass, ttl, rdataOffset, rdataLength):
+        self.message = message
+        self.nameOffset = nameOffset
+        self.type = type
+        self.rclass = rclass
+        self.ttl = ttl
+        self.rdataOffset = rdataOffset
+        self.rdataLength = rdataLength
+        self._rdata = None
+
+    @property
+    def name(self):
+        return self.message.nameAt(self.nameOffset)
+
+    @property
+    def raw(self):
+        return self.message.buf[self.rdataOffset : self.rdataOffset + self.rdataLength]
+
+    @property
+    def rdata(self):
+        """
+        Dotted/colon string for A/AAAA, a domain name for NS/CNAME/PTR and
+        the raw bytes for everything else
+        """
+        if self._rdata is None:
+            if self.type == TYPE_A and self.rdataLength == 4:
+                self._rdata = formatIPv4(self.raw)
+            elif self.type == TYPE_AAAA and self.rdataLength == 16:
+                self._rdata = formatIPv6(self.raw)
+            elif self.type in NAME_TYPES:
+                self._rdata = self.message.nameAt(self.rdataOffset)
+            else:
+                self._rdata = bytes(self.raw)
+        return self._rdata
+
+    def __repr__(self):
+        return f"Record({self.name!r}, type={self.type}, ttl={self.ttl}, rdata={self.rdata!r})"
+
+
+class Message:
+    """
+    A parsed DNS message. Holds a memoryview over the packet and a cache of
+    names already decoded at each offset, so compression pointers into the
+    same suffix are only walked once.
+    """
+
+    __slots__ = ("buf", "names", "header", "question", "answers", "authority", "additional")
+
+    def __init__(self, data):
+        self.buf = memoryview(data)
+        self.names = {}
+        self.header = None
+        self.question = None
+        self.answers = []
+        self.authority = []
+        self.additional = []
+
+    def nameAt(self, offset):
+        """
+        Decode the domain name starting at offset
+        """
+        names = self.names
+        known = names.get(offset)
+        if known is not None:
+            return known
+
+        buf = self.buf
+        starts = []
+        labels = []
+        suffix = ""
+        limit = offset + 1
+
+        while True:
+            known = names.get(offset)
+            if known is not None:
+                suffix = known
+                break
+
+            length = buf[offset]
+            if length == 0:
+                break
+
+            if length & 0xC0 == 0xC0:
+                pointer = ((length & 0x3F) << 8) | buf[offset + 1]
+                # only follow pointers backwards so a malicious packet can't loop
+                if pointer >= limit:
+                    raise ValueError(f"bad compression pointer at offset {offset}")
+                offset = limit = pointer
+                continue
+
+            end = offset + 1 + length
+            if end > len(buf):
+                raise ValueError(f"label runs past end of message at offset {offset}")
+            starts.append(offset)
+            labels.append(str(buf[offset + 1 : end], "utf-8", "replace"))
+            offset = end
+
+        for start, label in zip(reversed(starts), reversed(labels)):
+            suffix = f"{label}.{suffix}" if suffix else label
+            names[start] = suffix
+
+        return suffix
+
+    def skipName(self, offset):
+        """
+        Return the offset just past the name at offset without decoding it
+        """
+        buf = self.buf
+        while True:
+            length = buf[offset]
+            if length == 0:
+                return offset + 1
+            if length & 0xC0 == 0xC0:
+                return offset + 2
+            offset += 1 + length
+
+    def negativeTTL(self):
+        """
+        How long an NXDOMAIN/NODATA answer may be cached: the smaller of the
+        authority SOA's own TTL and its MINIMUM field (RFC 2308 section 5),
+        or None if there's no SOA
+        """
+        for record in self.authority:
+            # MINIMUM is the last of the five 32-bit fields after the two names
+            if record.type == TYPE_SOA and record.rdataLength >= 22:
+                end = record.rdataOffset + record.rdataLength
+                return min(record.ttl, struct.unpack_from("!I", self.buf, end - 4)[0])
+        return None
+
+    def parseRecords(self, offset, count, records):
+        buf = self.buf
+        size = len(buf)
+        unpack_from = RECORD.unpack_from
+        for _ in range(count):
+            nameOffset = offset
+            # skipName inlined, this loop runs once per record
+            while True:
+                length = buf[offset]
+                if length == 0:
+                    offset += 1
+                    break
+                if length & 0xC0 == 0xC0:
+                    offset += 2
+                    break
+                offset += 1 + length
+            if offset + RECORD.size > size:
+                raise ValueError("record header runs past end of message")
+            rType, rClass, ttl, rDataLength = unpack_from(buf, offset)
+            offset += RECORD.size
+            if offset + rDataLength > size:
+                raise ValueError("rdata runs past end of message")
+            records.append(Record(self, nameOffset, rType, rClass, ttl, offset, rDataLength))
+            offset += rDataLength
+        return offset
+
+
+def parseMessage(data):
+    """
+    Parse a DNS message. Truncated or malformed sections stop parsing and
+    keep whatever records came before them, a short header raises
+    struct.error.
+    """
+    message = Message(data)
+    header = message.header = Header(*HEADER.unpack_from(message.buf, 0))
+
+    try:
+        offset = HEADER.size
+        if header.numQuestions:
+            nameOffset = offset
+            offset = message.skipName(offset)
+            typeDNS, classDNS = QUESTION.unpack_from(message.buf, offset)
+            offset += QUESTION.size
+            message.question = Question(message.nameAt(nameOffset), typeDNS, classDNS)
+
+        offset = message.parseRecords(offset, header.numAnswers, message.answers)
+        offset = message.parseRecords(offset, header.numAuthorities, message.authority)
+        message.parseRecords(offset, header.numAdditionals, message.additional)
+    except (struct.error, IndexError, ValueError) as e:
+        print(f"Error parsing DNS message: {e}")
+
+    return message
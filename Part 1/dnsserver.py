@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import collections
+import os
+import socket
+import struct
+import time
+
+from dnsasync import SOCKET_BUFFER_SIZE, AsyncResolver
+from dnscache import normalize_name
+from dnsdiskcache import PersistentDNSCache
+from dnsmessage import NAME_TYPES, TYPE_A, TYPE_AAAA, TYPE_OPT, encodeName, parseMessage
+
+HOST = "127.0.0.1"
+PORT = 10053
+# plain DNS over UDP without EDNS0, anything longer gets TC and a TCP retry
+MAX_UDP_RESPONSE = 512
+# the most we send over UDP to an EDNS0 client, however big a buffer it offers
+MAX_EDNS_RESPONSE = 4096
+# the OPT pseudo-record we answer EDNS0 queries with: root name, our UDP
+# payload size in the class field, no extended flags, no options
+OPT_RECORD = b"\x00" + struct.pack("!HHIH", TYPE_OPT, MAX_EDNS_RESPONSE, 0, 0)
+STATS_INTERVAL = 10.0
+# latencies kept for the percentile report
+LATENCY_SAMPLES = 100000
+
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+# the types whose rdata we can re-encode. Anything else (MX, SOA, SRV, ...) comes
+# from upstream as raw rdata, which may hold compression pointers into a
+# message we no longer have, so we answer NOTIMP rather than relay it.
+SERVED_TYPES = (TYPE_A, TYPE_AAAA) + NAME_TYPES
+
+
+def encodeRdata(record):
+    if record["type"] == TYPE_A:
+        return socket.inet_aton(record["ip"])
+    if record["type"] == TYPE_AAAA:
+        return socket.inet_pton(socket.AF_INET6, record["ip"])
+    return encodeName(record["target"])
+
+
+def buildResponse(query, question_end, rcode, answers=(), ttl=None, edns=False):
+    """
+    Build a response to query, echoing its ID, RD bit and question section.
+    With a ttl (what's left of the cached answer), no record claims more.
+    With edns, an OPT record goes in the additional section.
+    """
+    answers = [record for record in answers if record["type"] in SERVED_TYPES]
+    qid, flags = struct.unpack_from("!HH", query)
+    # QR, same opcode and RD as the query, RA since we recurse for the client
+    flags = 0x8000 | (flags & 0x7900) | 0x0080 | rcode
+
+    numQuestions = 1 if question_end > 12 else 0
+    body = [struct.pack("!HHHHHH", qid, flags, numQuestions, len(answers), 0, int(edns)), bytes(query[12:question_end])]
+    for record in answers:
+        rdata = encodeRdata(record)
+        body.append(encodeName(record["name"]))
+        record_ttl = record["ttl"] if ttl is None else min(record["ttl"], ttl)
+        body.append(struct.pack("!HHIH", record["type"], record.get("class", 1), record_ttl, len(rdata)))
+        body.append(rdata)
+    if edns:
+        body.append(OPT_RECORD)
+    return b"".join(body)
+
+
+def truncate(response, question_end, edns=False):
+    """
+    Cut a response down to its header, question and (with edns) OPT
+    record, with TC set
+    """
+    header = bytearray(response[:12])
+    header[2] |= 0x02
+    struct.pack_into("!HHH", header, 6, 0, 0, int(edns))
+    return bytes(header) + response[12:question_end] + (OPT_RECORD if edns else b"")
+
+
+class ServerStats:
+    """
+    Query counters and a window of recent latencies
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.queries = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.last_report = self.started
+        self.last_queries = 0
+
+    def percentile(self, ordered, fraction):
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def report(self):
+        now = time.monotonic()
+        interval = now - self.last_report
+        qps = (self.queries - self.last_queries) / interval if interval > 0 else 0.0
+        self.last_report, self.last_queries = now, self.queries
+
+        ordered = sorted(self.latencies)
+        hit_ratio = self.cache_hits / self.queries if self.queries else 0.0
+        return {
+            "queries": self.queries,
+            "qps": round(qps, 1),
+            "cache_hit_ratio": round(hit_ratio, 3),
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "p50_ms": round(self.percentile(ordered, 0.50) * 1000, 2),
+            "p90_ms": round(self.percentile(ordered, 0.90) * 1000, 2),
+            "p99_ms": round(self.percentile(ordered, 0.99) * 1000, 2),
+        }
+
+
+class StubServer:
+    """
+    Answers ordinary recursive DNS queries from local clients using the
+    iterative AsyncResolver and its cache. Identical queries that arrive
+    while one is being resolved share that resolution.
+    """
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.stats = ServerStats()
+
+    async def answer(self, query):
+        """
+        Return (response, question_end, edns_size) for a raw query, or None
+        if it's too broken to reply to. edns_size is the most an EDNS0 client
+        takes over UDP, None for a plain DNS client.
+        """
+        start_time = time.perf_counter()
+        try:
+            message = parseMessage(query)
+        except struct.error:
+            return None
+
+        question = message.question
+        if question is None or message.header.flags & 0x8000:
+            return buildResponse(query, 12, RCODE_FORMERR), 12, None
+
+        question_end = message.skipName(12) + 4
+        # an EDNS0 client gives the UDP payload size it takes in its OPT record's class
+        edns_size = None
+        for record in message.additional:
+            if record.type == TYPE_OPT:
+                edns_size = min(max(record.rclass, MAX_UDP_RESPONSE), MAX_EDNS_RESPONSE)
+
+        name, typeDNS = normalize_name(question.name), question.type
+        self.stats.queries += 1
+        if typeDNS in SERVED_TYPES:
+            rcode, answers = await self.lookup(name, typeDNS)
+        else:
+            rcode, answers = RCODE_NOTIMP, []
+        # the records' TTLs are from when they were fetched, the cache knows what's left
+        ttl = self.resolver.cache.answer_ttl(name, typeDNS) if answers else None
+        response = buildResponse(query, question_end, rcode, answers, ttl, edns_size is not None)
+
+        self.stats.latencies.append(time.perf_counter() - start_time)
+        return response, question_end, edns_size
+
+    async def lookup(self, name, typeDNS):
+        """
+        Return (rcode, records) for a question. A wholly cached answer
+        (including a negative one) is served from one cache lookup,
+        anything else goes to the resolver, which keeps the CNAMEs that
+        lead to an NXDOMAIN or NODATA.
+        """
+        cache = self.resolver.cache
+        cached = cache.get_answer(name, typeDNS)
+        if cached == []:
+            self.stats.cache_hits += 1
+            return (RCODE_NXDOMAIN if cache.is_nxdomain(name) else RCODE_NOERROR), []
+        # a name's own cached records may be just the first CNAME of a chain
+        if cached and any(record["type"] == typeDNS for record in cached):
+            self.stats.cache_hits += 1
+            return RCODE_NOERROR, cached
+        if (name, typeDNS) in self.resolver.resolving:
+            self.stats.coalesced += 1
+
+        rcode, chain = await self.resolver.resolve_answer(name, typeDNS)
+        if rcode is None:
+            self.stats.failures += 1
+            return RCODE_SERVFAIL, []
+        return rcode, chain
+
+    async def answer_udp(self, transport, query, addr):
+        result = await self.answer(query)
+        if result is None:
+            return
+        response, question_end, edns_size = result
+        if len(response) > (edns_size or MAX_UDP_RESPONSE):
+            response = truncate(response, question_end, edns_size is not None)
+        transport.sendto(response, addr)
+
+    async def handle_tcp(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+                query = await reader.readexactly(length)
+                # queries on one connection may be answered out of order
+                task = asyncio.ensure_future(self.answer_tcp(writer, query))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.wait(tasks)
+            writer.close()
+
+    async def answer_tcp(self, writer, query):
+        result = await self.answer(query)
+        if result is not None and not writer.is_closing():
+            writer.write(struct.pack("!H", len(result[0])) + result[0])
+
+    async def print_stats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            print(self.stats.report())
+
+
+class UDPServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        task = asyncio.ensure_future(self.server.answer_udp(self.transport, data, addr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+async def serve(host=HOST, port=PORT, cache=None, stats_interval=STATS_INTERVAL):
+    loop = asyncio.get_running_loop()
+    async with AsyncResolver(cache=cache) as resolver:
+        server = StubServer(resolver)
+        # a big receive buffer so bursts from many clients aren't dropped
+        # (the kernel may cap it at net.core.rmem_max)
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        except OSError:
+            pass
+        udp_socket.bind((host, port))
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: UDPServerProtocol(server), sock=udp_socket
+        )
+        tcp_server = await asyncio.start_server(server.handle_tcp, host, port)
+        print(f"Serving DNS on {host}:{port} (UDP and TCP)")
+
+        reporter = asyncio.ensure_future(server.print_stats(stats_interval))
+        try:
+            async with tcp_server:
+                await tcp_server.serve_forever()
+        finally:
+            reporter.cancel()
+            transport.close()
+            print(server.stats.report())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local DNS server in front of the iterative resolver")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--cache-file", default=os.environ.get("DNS_CACHE_FILE"),
+                        help="SQLite file to keep the DNS cache in between runs")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        help="seconds between QPS/cache/latency reports")
+    args = parser.parse_args(argv)
+
+    cache = PersistentDNSCache(args.cache_file) if args.cache_file else None
+    try:
+        asyncio.run(serve(args.host, args.port, cache, args.stats_interval))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import random
+import time
+
+# weight of a new RTT sample in the smoothed RTT (BIND uses 0.3 as well)
+SRTT_ALPHA = 0.3
+RTTVAR_BETA = 0.25
+# unknown servers start with a small random SRTT so each gets probed early
+INITIAL_SRTT = (0.001, 0.032)
+# how long a timeout counts against a server, halved every FAILURE_HALF_LIFE
+TIMEOUT_PENALTY = 2.0
+FAILURE_HALF_LIFE = 60.0
+MIN_HEDGE_DELAY = 0.05
+MAX_HEDGE_DELAY = 1.0
+
+
+class ServerStats:
+    """
+    Smoothed RTT and failure score for one nameserver IP
+    """
+
+    __slots__ = ("ip", "srtt", "rttvar", "failures", "failed_at", "queries", "responses", "timeouts", "errors",
+                 "last_rtt")
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.srtt = random.uniform(*INITIAL_SRTT)
+        self.rttvar = self.srtt / 2
+        self.failures = 0.0
+        self.failed_at = 0.0
+        self.queries = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.last_rtt = None
+
+    def failure_score(self, now):
+        if not self.failures:
+            return 0.0
+        return self.failures * 0.5 ** ((now - self.failed_at) / FAILURE_HALF_LIFE)
+
+    def score(self, now):
+        return self.srtt + TIMEOUT_PENALTY * self.failure_score(now)
+
+    def as_dict(self, now=None):
+        now = time.monotonic() if now is None else now
+        return {
+            "ip": self.ip,
+            "srtt_ms": round(self.srtt * 1000, 2),
+            "rttvar_ms": round(self.rttvar * 1000, 2),
+            "last_rtt_ms": None if self.last_rtt is None else round(self.last_rtt * 1000, 2),
+            "failure_score": round(self.failure_score(now), 3),
+            "queries": self.queries,
+            "responses": self.responses,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+        }
+
+
+class NameserverTable:
+    """
+    Per-IP RTT bookkeeping used to pick which server to ask first and how
+    long to wait before hedging to the next one
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.servers = {}
+
+    def get(self, ip):
+        stats = self.servers.get(ip)
+        if stats is None:
+            stats = self.servers[ip] = ServerStats(ip)
+        return stats
+
+    def order(self, ips):
+        """
+        Return ips sorted fastest first
+        """
+        now = self.clock()
+        return sorted(ips, key=lambda ip: self.get(ip).score(now))
+
+    def hedge_delay(self, ip):
+        """
+        How long to give ip before also asking the next server: its expected
+        RTT plus some slack, like a TCP retransmit timer
+        """
+        stats = self.get(ip)
+        if not stats.responses:
+            return MAX_HEDGE_DELAY / 4
+        delay = stats.srtt + 4 * stats.rttvar
+        return min(MAX_HEDGE_DELAY, max(MIN_HEDGE_DELAY, delay))
+
+    def sent(self, ip):
+        self.get(ip).queries += 1
+
+    def response(self, ip, rtt):
+        stats = self.get(ip)
+        if not stats.responses:
+            stats.srtt = rtt
+            stats.rttvar = rtt / 2
+        else:
+            stats.rttvar += RTTVAR_BETA * (abs(stats.srtt - rtt) - stats.rttvar)
+            stats.srtt += SRTT_ALPHA * (rtt - stats.srtt)
+        stats.responses += 1
+        stats.last_rtt = rtt
+        # a server that answers is forgiven its earlier timeouts
+        stats.failures = 0.0
+
+    def timeout(self, ip):
+        self.fail(ip).timeouts += 1
+
+    def error(self, ip):
+        """
+        ip answered, but with SERVFAIL, REFUSED or another error rcode: it's
+        up but of no use, which counts against it like a timeout
+        """
+        self.fail(ip).errors += 1
+
+    def fail(self, ip):
+        stats = self.get(ip)
+        now = self.clock()
+        stats.failures = stats.failure_score(now) + 1
+        stats.failed_at = now
+        return stats
+
+    def report(self, ips=None):
+        """
+        Return the stats for ips (or every known server) as dicts, slowest first
+        """
+        now = self.clock()
+        rows = [self.get(ip) for ip in ips] if ips is not None else list(self.servers.values())
+        rows.sort(key=lambda stats: stats.score(now), reverse=True)
+        return [stats.as_dict(now) for stats in rows]
+
+    def print_report(self, limit=20):
+        print(f"{'server':<40} {'srtt ms':>9} {'last ms':>9} {'fail':>6} {'sent':>7} {'recv':>7} {'lost':>6} {'err':>5}")
+        for row in self.report()[:limit]:
+            last = "-" if row["last_rtt_ms"] is None else row["last_rtt_ms"]
+            print(
+                f"{row['ip']:<40} {row['srtt_ms']:>9} {last:>9} {row['failure_score']:>6} "
+                f"{row['queries']:>7} {row['responses']:>7} {row['timeouts']:>6} {row['errors']:>5}"
+            )
@@ -0,0 +1,114 @@
+import asyncio
+import socket
+import struct
+import threading
+
+DNS_PORT = 53
+TIMEOUT = 10
+
+
+def recv_exactly(tcp_socket, length):
+    """
+    Read exactly length bytes from a TCP socket
+    """
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = tcp_socket.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("connection closed mid-message")
+        received += count
+    return bytes(buffer)
+
+
+class TCPConnections:
+    """
+    Persistent DNS-over-TCP connections, one per server, using the two byte
+    length prefix framing from RFC 1035 section 4.2.2
+    """
+
+    def __init__(self, port=DNS_PORT, timeout=TIMEOUT):
+        self.port = port
+        self.timeout = timeout
+        self.sockets = {}
+        # queries from different threads take turns, so their messages don't interleave
+        self.lock = threading.Lock()
+
+    def query(self, server_ip, request):
+        """
+        Send request to server_ip over TCP and return the response, or None.
+        A reused connection the server has since closed is reopened once.
+        """
+        with self.lock:
+            return self.send(server_ip, request)
+
+    def send(self, server_ip, request):
+        for _ in range(2):
+            tcp_socket = self.sockets.get(server_ip)
+            fresh = tcp_socket is None
+            try:
+                if fresh:
+                    tcp_socket = socket.create_connection((server_ip, self.port), self.timeout)
+                    self.sockets[server_ip] = tcp_socket
+
+                tcp_socket.sendall(struct.pack("!H", len(request)) + request)
+                length = struct.unpack("!H", recv_exactly(tcp_socket, 2))[0]
+                return recv_exactly(tcp_socket, length)
+            except OSError as e:
+                self.close(server_ip)
+                if fresh:
+                    print(f"TCP query to {server_ip} failed: {e}")
+                    return None
+        return None
+
+    def close(self, server_ip=None):
+        ips = [server_ip] if server_ip is not None else list(self.sockets)
+        for ip in ips:
+            tcp_socket = self.sockets.pop(ip, None)
+            if tcp_socket is not None:
+                tcp_socket.close()
+
+
+class AsyncTCPConnections:
+    """
+    asyncio version of TCPConnections. Queries to the same server take turns
+    on its connection.
+    """
+
+    def __init__(self, port=DNS_PORT, timeout=TIMEOUT):
+        self.port = port
+        self.timeout = timeout
+        self.connections = {}
+        self.locks = {}
+
+    async def query(self, server_ip, request):
+        lock = self.locks.setdefault(server_ip, asyncio.Lock())
+        async with lock:
+            for _ in range(2):
+                connection = self.connections.get(server_ip)
+                fresh = connection is None
+                try:
+                    if fresh:
+                        connection = await asyncio.wait_for(
+                            asyncio.open_connection(server_ip, self.port), self.timeout
+                        )
+                        self.connections[server_ip] = connection
+
+                    reader, writer = connection
+                    writer.write(struct.pack("!H", len(request)) + request)
+                    await writer.drain()
+                    length = struct.unpack("!H", await asyncio.wait_for(reader.readexactly(2), self.timeout))[0]
+                    return await asyncio.wait_for(reader.readexactly(length), self.timeout)
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    self.close(server_ip)
+                    if fresh:
+                        return None
+        return None
+
+    def close(self, server_ip=None):
+        ips = [server_ip] if server_ip is not None else list(self.connections)
+        for ip in ips:
+            connection = self.connections.pop(ip, None)
+            if connection is not None:
+                connection[1].close()
@@ -0,0 +1,221 @@
+BUFFER_SIZE = 64 * 1024
+# a response whose status line and headers don't fit in this is rejected
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class HTTPError(Exception):
+    pass
+
+
+class HTTPResponse:
+    """
+    Status line and headers of a response. Header names are kept as sent,
+    get() looks them up case-insensitively.
+    """
+
+    def __init__(self, version, status, reason, headers):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.fields = {}
+        for name, value in headers:
+            key = name.lower()
+            # repeated fields are combined as RFC 9110 section 5.3 allows
+            self.fields[key] = f"{self.fields[key]}, {value}" if key in self.fields else value
+        self.body_length = 0
+
+    @property
+    def status_line(self):
+        return f"{self.version} {self.status} {self.reason}".rstrip()
+
+    def get(self, name, default=None):
+        return self.fields.get(name.lower(), default)
+
+    @property
+    def chunked(self):
+        return "chunked" in self.get("transfer-encoding", "").lower()
+
+    @property
+    def keep_alive(self):
+        connection = self.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return "keep-alive" in connection
+        return "close" not in connection
+
+
+def parse_head(data):
+    """
+    Parse the status line and header fields (without the blank line)
+    """
+    lines = bytes(data).decode("iso-8859-1").split("\r\n")
+    version, _, rest = lines[0].partition(" ")
+    status, _, reason = rest.partition(" ")
+    if not version.startswith("HTTP/") or not status.isdigit():
+        raise HTTPError(f"bad status line {lines[0]!r}")
+
+    headers = []
+    for line in lines[1:]:
+        if line[:1] in (" ", "\t") and headers:
+            # obsolete line folding
+            headers[-1] = (headers[-1][0], f"{headers[-1][1]} {line.strip()}")
+            continue
+        name, colon, value = line.partition(":")
+        if not colon:
+            raise HTTPError(f"bad header line {line!r}")
+        headers.append((name.strip(), value.strip()))
+    return HTTPResponse(version, int(status), reason, headers)
+
+
+class HTTPResponseReader:
+    """
+    Incremental HTTP/1.1 response parser for one connection. Everything is
+    received into one preallocated buffer with recv_into, and bodies are
+    handed out in pieces as they arrive, so memory use doesn't depend on
+    the size of the response. Bytes past the end of one response are kept
+    for the next, so the reader can be used again on a kept-alive
+    connection.
+    """
+
+    def __init__(self, sock, buffer_size=BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # unread data is buffer[start:end]
+        self.start = 0
+        self.end = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Receive more data after what's buffered. Returns False at EOF.
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            if self.start == 0:
+                raise HTTPError("buffer full")
+            # move the unread tail to the front to make room
+            length = self.end - self.start
+            self.buffer[:length] = bytes(self.view[self.start : self.end])
+            self.start, self.end = 0, length
+
+        count = self.sock.recv_into(self.view[self.end :])
+        if not count:
+            self.eof = True
+            return False
+        self.end += count
+        return True
+
+    def read_line(self):
+        """
+        Return the next CRLF-terminated line without its line ending
+        """
+        # how much of the unread data has been searched already, kept relative
+        # to start since fill() may move the data to the front of the buffer
+        scanned = 0
+        while True:
+            index = self.buffer.find(b"\r\n", self.start + scanned, self.end)
+            if index >= 0:
+                line = bytes(self.view[self.start : index])
+                self.start = index + 2
+                return line
+            scanned = max(0, self.end - self.start - 1)
+            if self.end - self.start >= MAX_HEADER_SIZE:
+                raise HTTPError("line too long")
+            if not self.fill():
+                raise HTTPError("connection closed mid-line")
+
+    def read_head(self):
+        """
+        Read the status line and headers of the next response, skipping any
+        1xx interim responses
+        """
+        while True:
+            scanned = 0
+            while True:
+                index = self.buffer.find(b"\r\n\r\n", self.start + scanned, self.end)
+                if index >= 0:
+                    break
+                # the terminator may straddle what we have and the next read
+                scanned = max(0, self.end - self.start - 3)
+                if self.end - self.start >= MAX_HEADER_SIZE:
+                    raise HTTPError("response headers too long")
+                if not self.fill():
+                    if self.start == self.end:
+                        raise HTTPError("connection closed before a response")
+                    raise HTTPError("connection closed mid-headers")
+
+            response = parse_head(self.view[self.start : index])
+            self.start = index + 4
+            if not 100 <= response.status < 200 or response.status == 101:
+                return response
+
+    def read_body(self, response, method="GET"):
+        """
+        Yield the body of response in pieces. Each piece is a memoryview into
+        the receive buffer that's only valid until the next one is asked for.
+        """
+        if method == "HEAD" or response.status in (204, 304) or 100 <= response.status < 200:
+            return
+        if response.chunked:
+            pieces = self.read_chunked()
+        elif response.get("content-length") is not None:
+            try:
+                length = int(response.get("content-length").split(",")[0])
+            except ValueError:
+                raise HTTPError(f"bad Content-Length {response.get('content-length')!r}")
+            pieces = self.read_exactly(length)
+        else:
+            # no framing, the body runs until the server closes the connection
+            pieces = self.read_until_close()
+
+        for piece in pieces:
+            response.body_length += len(piece)
+            yield piece
+
+    def read_exactly(self, length):
+        while length > 0:
+            if self.start == self.end and not self.fill():
+                raise HTTPError(f"connection closed with {length} bytes of body missing")
+            count = min(length, self.end - self.start)
+            yield self.view[self.start : self.start + count]
+            self.start += count
+            length -= count
+
+    def read_until_close(self):
+        while True:
+            if self.start == self.end and not self.fill():
+                return
+            piece = self.view[self.start : self.end]
+            self.start = self.end
+            yield piece
+
+    def read_chunked(self):
+        while True:
+            size_line = self.read_line()
+            try:
+                # chunk extensions after ";" are allowed and ignored
+                size = int(size_line.split(b";")[0].strip(), 16)
+            except ValueError:
+                raise HTTPError(f"bad chunk size line {size_line!r}")
+            if size == 0:
+                break
+            yield from self.read_exactly(size)
+            if self.read_line():
+                raise HTTPError("chunk not followed by CRLF")
+
+        # trailer fields, up to a blank line
+        while self.read_line():
+            pass
+
+    def read_response(self, output=None, method="GET"):
+        """
+        Read one complete response, writing its body to output (any object
+        with a write method) if given. Returns the HTTPResponse.
+        """
+        response = self.read_head()
+        for piece in self.read_body(response, method):
+            if output is not None:
+                output.write(piece)
+        return response
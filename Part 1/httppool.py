@@ -0,0 +1,320 @@
+import collections
+import errno
+import itertools
+import os
+import select
+import socket
+import threading
+import time
+
+from httpclient import HTTPError, HTTPResponseReader
+from timing import timings as default_timings
+
+HTTP_PORT = 80
+TIMEOUT = 10
+# idle connections older than this are closed rather than reused, servers
+# commonly drop them after 5-60 seconds
+IDLE_TIMEOUT = 15.0
+MAX_PER_HOST = 6
+# requests sent ahead of their responses when pipelining
+PIPELINE_DEPTH = 8
+USER_AGENT = "Custom-Client/1.0"
+# RFC 8305 section 5: start the next connection attempt after this long
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+
+def build_request(host, path="/", method="GET", headers=()):
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {host}", f"User-Agent: {USER_AGENT}", "Accept: */*"]
+    lines += [f"{name}: {value}" for name, value in headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+
+def address_family(ip):
+    return socket.AF_INET6 if ":" in ip else socket.AF_INET
+
+
+def interleave_addresses(ipv6, ipv4):
+    """
+    Alternate between the two address families, IPv6 first, as RFC 8305
+    section 4 describes
+    """
+    return [ip for pair in itertools.zip_longest(ipv6, ipv4) for ip in pair if ip is not None]
+
+
+def connect_happy_eyeballs(addresses, port, timeout=TIMEOUT, attempt_delay=CONNECTION_ATTEMPT_DELAY):
+    """
+    Race TCP connects to addresses in order, starting the next one every
+    attempt_delay or as soon as an attempt fails, and return
+    (socket, address) for the first to complete. A blackholed address
+    costs attempt_delay instead of a full connect timeout.
+    """
+    deadline = time.monotonic() + timeout
+    pending = list(addresses)
+    attempts = {}
+    next_attempt = 0.0
+    error = None
+    try:
+        while pending or attempts:
+            now = time.monotonic()
+            if now >= deadline:
+                raise socket.timeout(f"timed out connecting to {', '.join(addresses)}")
+
+            if pending and (now >= next_attempt or not attempts):
+                ip = pending.pop(0)
+                try:
+                    sock = socket.socket(address_family(ip), socket.SOCK_STREAM)
+                except OSError as e:
+                    # e.g. no IPv6 on this machine at all
+                    error = e
+                    continue
+                sock.setblocking(False)
+                code = sock.connect_ex((ip, port))
+                if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    sock.close()
+                    error = OSError(code, os.strerror(code))
+                    continue
+                attempts[sock] = ip
+                next_attempt = now + attempt_delay
+
+            wait = deadline - now
+            if pending:
+                wait = min(wait, max(0.0, next_attempt - now))
+            _, writable, _ = select.select([], list(attempts), [], wait)
+            for sock in writable:
+                ip = attempts.pop(sock)
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0:
+                    sock.settimeout(timeout)
+                    return sock, ip
+                sock.close()
+                error = OSError(code, f"{os.strerror(code)} ({ip})")
+                # a failed attempt lets the next one start right away
+                next_attempt = 0.0
+
+        raise error or OSError("no addresses to connect to")
+    finally:
+        # the losers, the winner has already been taken out
+        for sock in attempts:
+            sock.close()
+
+
+class HTTPConnection:
+    """
+    One kept-alive TCP connection and the reader that parses its responses
+    """
+
+    def __init__(self, key, sock):
+        self.key = key
+        self.sock = sock
+        self.reader = HTTPResponseReader(sock)
+        self.last_used = time.monotonic()
+        self.requests = 0
+
+    def is_stale(self):
+        """
+        Check whether the server has closed an idle connection (or sent
+        something we didn't ask for, which makes it unusable too)
+        """
+        if self.reader.start != self.reader.end:
+            return True
+        try:
+            return bool(select.select([self.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def close(self):
+        self.sock.close()
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP/1.1 connections keyed by (ip, port, Host), so fetching
+    several paths from one server costs one TCP handshake. At most
+    max_per_host connections are open per (port, Host); callers wait for
+    one to come back when they're all busy.
+    """
+
+    def __init__(self, max_per_host=MAX_PER_HOST, idle_timeout=IDLE_TIMEOUT, timeout=TIMEOUT,
+                 pipeline_depth=PIPELINE_DEPTH, timings=None):
+        self.max_per_host = max_per_host
+        self.timings = default_timings if timings is None else timings
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.pipeline_depth = pipeline_depth
+        self.idle = collections.defaultdict(list)
+        self.open_count = collections.Counter()
+        self.condition = threading.Condition()
+        self.connections_opened = 0
+        self.requests = 0
+        self.reused = 0
+
+    def acquire(self, ip, port, host):
+        """
+        Return an idle connection for the key, or a new one if there are
+        fewer than max_per_host open. ip can also be a list of addresses
+        for the same server, which are raced with connect_happy_eyeballs.
+        """
+        ips = [ip] if isinstance(ip, str) else list(ip)
+        host = host.lower()
+        with self.condition:
+            while True:
+                for candidate in ips:
+                    idle = self.idle[(candidate, port, host)]
+                    while idle:
+                        connection = idle.pop()
+                        if time.monotonic() - connection.last_used < self.idle_timeout and not connection.is_stale():
+                            self.reused += 1
+                            return connection
+                        self.discard_locked(connection)
+                if self.open_count[(port, host)] < self.max_per_host:
+                    self.open_count[(port, host)] += 1
+                    break
+                self.condition.wait()
+
+        try:
+            with self.timings.span("connect", host=host, port=port) as span:
+                if len(ips) == 1:
+                    sock = socket.create_connection((ips[0], port), self.timeout)
+                    connected_ip = ips[0]
+                else:
+                    sock, connected_ip = connect_happy_eyeballs(ips, port, self.timeout)
+                span["ip"] = connected_ip
+        except OSError:
+            with self.condition:
+                self.open_count[(port, host)] -= 1
+                self.condition.notify()
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections_opened += 1
+        return HTTPConnection((connected_ip, port, host), sock)
+
+    def release(self, connection, reusable=True):
+        """
+        Hand a connection back after its last response has been read in
+        full. Connections that can't carry another request are closed.
+        """
+        with self.condition:
+            if reusable and not connection.reader.eof:
+                connection.last_used = time.monotonic()
+                self.idle[connection.key].append(connection)
+            else:
+                self.discard_locked(connection)
+            self.condition.notify()
+
+    def discard_locked(self, connection):
+        connection.close()
+        # the cap is per server name, whichever of its addresses we reached
+        self.open_count[connection.key[1:]] -= 1
+
+    def request(self, ip, host, path="/", output=None, port=HTTP_PORT, method="GET", headers=()):
+        """
+        Send one request and stream the response body into output. Returns
+        the HTTPResponse. A reused connection the server has quietly closed
+        is replaced and the request retried once.
+        """
+        request = build_request(host, path, method, headers)
+        for attempt in range(2):
+            connection = self.acquire(ip, port, host)
+            fresh = connection.requests == 0
+            try:
+                # time to first byte, counted up to the end of the headers
+                with self.timings.span("ttfb", host=host, ip=connection.key[0], path=path, reused=not fresh):
+                    connection.sock.sendall(request)
+                    connection.requests += 1
+                    self.requests += 1
+                    response = connection.reader.read_head()
+            except (OSError, HTTPError):
+                self.release(connection, reusable=False)
+                if fresh or attempt:
+                    raise
+                continue
+
+            try:
+                with self.timings.span("body", host=host, path=path) as span:
+                    for piece in connection.reader.read_body(response, method):
+                        if output is not None:
+                            output.write(piece)
+                    span["bytes"] = response.body_length
+            except BaseException:
+                self.release(connection, reusable=False)
+                raise
+            response.address = connection.key[0]
+            self.release(connection, response.keep_alive)
+            return response
+
+    def fetch_all(self, ip, host, paths, outputs=None, port=HTTP_PORT, pipeline=False):
+        """
+        GET every path from one server over a single connection, writing
+        each body to the matching entry of outputs (if given). With
+        pipeline, up to pipeline_depth requests are sent before their
+        responses are read. Returns the responses in order. If a new
+        connection can't get a single response through, the rest are
+        fetched one request per connection instead.
+        """
+        paths = list(paths)
+        outputs = list(outputs) if outputs is not None else [None] * len(paths)
+        if not pipeline:
+            return [self.request(ip, host, path, output, port) for path, output in zip(paths, outputs)]
+
+        responses = []
+        while len(responses) < len(paths):
+            connection = self.acquire(ip, port, host)
+            fresh = connection.requests == 0
+            done_before = len(responses)
+            queued = collections.deque()
+            next_index = len(responses)
+            in_body = False
+            sending = True
+            reusable = False
+            try:
+                while len(responses) < len(paths):
+                    # keep the pipe full, responses come back in request order
+                    while sending and next_index < len(paths) and len(queued) < self.pipeline_depth:
+                        try:
+                            connection.sock.sendall(build_request(host, paths[next_index]))
+                        except OSError:
+                            # the server may have answered what's queued and closed
+                            # (Connection: close), so read those before moving on
+                            sending = False
+                            break
+                        connection.requests += 1
+                        self.requests += 1
+                        queued.append(next_index)
+                        next_index += 1
+                    if not queued:
+                        break
+
+                    response = connection.reader.read_head()
+                    output = outputs[queued.popleft()]
+                    in_body = True
+                    for piece in connection.reader.read_body(response):
+                        if output is not None:
+                            output.write(piece)
+                    in_body = False
+                    response.address = connection.key[0]
+                    responses.append(response)
+                    reusable = sending and response.keep_alive
+                    if not response.keep_alive:
+                        # the server won't answer the rest, resend them on another connection
+                        break
+            except BaseException as e:
+                self.release(connection, reusable=False)
+                # part of a body has been written by now, don't retry
+                if in_body or not isinstance(e, (OSError, HTTPError)):
+                    raise
+            else:
+                self.release(connection, reusable)
+            if not fresh or len(responses) > done_before:
+                continue
+
+            # a brand new connection got nowhere, so this server doesn't take pipelined requests
+            for path, output in zip(paths[len(responses):], outputs[len(responses):]):
+                responses.append(self.request(ip, host, path, output, port))
+        return responses
+
+    def close(self):
+        with self.condition:
+            for connections in self.idle.values():
+                for connection in connections:
+                    self.discard_locked(connection)
+            self.idle.clear()
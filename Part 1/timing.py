@@ -0,0 +1,164 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+# histogram buckets are 1/2**SUB_BUCKET_BITS of a power of two wide, so any
+# percentile is within about 6% of the true value
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+
+def dns_phase(zone):
+    """
+    Name the resolution hop that asks the servers for zone: "root", "tld"
+    for a single-label zone and "auth" for anything further down
+    """
+    if not zone:
+        return "root"
+    if "." not in zone:
+        return "tld"
+    return "auth"
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of durations in nanoseconds. Fixed relative
+    precision and memory, and two histograms can be merged.
+    """
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def bucket(value):
+        shift = max(0, value.bit_length() - SUB_BUCKET_BITS - 1)
+        return shift * SUB_BUCKETS + (value >> shift)
+
+    @staticmethod
+    def bucket_value(index):
+        """
+        The middle of the range of values that land in bucket index
+        """
+        if index < 2 * SUB_BUCKETS:
+            return index
+        shift = index // SUB_BUCKETS - 1
+        low = (index - shift * SUB_BUCKETS) << shift
+        return low + (1 << shift) // 2
+
+    def record(self, value):
+        value = max(0, int(value))
+        self.buckets[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        rank = min(self.count - 1, int(fraction * self.count))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return min(self.max, max(self.min, self.bucket_value(index)))
+        return self.max
+
+    def summary(self):
+        """
+        Count and latency percentiles in milliseconds
+        """
+        def ms(value):
+            return round(value / 1e6, 3)
+
+        return {
+            "count": self.count,
+            "mean_ms": ms(self.total / self.count) if self.count else 0.0,
+            "p50_ms": ms(self.percentile(0.50)),
+            "p90_ms": ms(self.percentile(0.90)),
+            "p99_ms": ms(self.percentile(0.99)),
+            "max_ms": ms(self.max or 0),
+        }
+
+
+class Timings:
+    """
+    Collects timing spans for named phases (root, tld, auth, connect, ttfb,
+    body, ...) into one histogram per phase, and optionally writes each span
+    as a JSON line to output
+    """
+
+    def __init__(self, output=None):
+        self.output = output
+        self.histograms = collections.defaultdict(LatencyHistogram)
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        """
+        Append JSON lines to the file at path from now on
+        """
+        self.output = open(path, "a", buffering=1)
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+    def record(self, phase, start_ns, end_ns, ok=True, **fields):
+        duration = end_ns - start_ns
+        with self.lock:
+            self.histograms[phase].record(duration)
+            if self.output is not None:
+                event = {"phase": phase, "start_ns": start_ns, "duration_ns": duration, "ok": ok}
+                event.update(fields)
+                self.output.write(json.dumps(event, default=str) + "\n")
+
+    @contextlib.contextmanager
+    def span(self, phase, **fields):
+        """
+        Time the body of a with block as one span of phase. The yielded dict
+        can be filled in with more fields before the block ends, including
+        "ok": False for a failure that didn't raise.
+        """
+        start_ns = time.perf_counter_ns()
+        ok = True
+        try:
+            yield fields
+        except BaseException as e:
+            ok = False
+            fields.setdefault("error", type(e).__name__)
+            raise
+        finally:
+            ok = fields.pop("ok", True) and ok
+            self.record(phase, start_ns, time.perf_counter_ns(), ok, **fields)
+
+    def summary(self):
+        with self.lock:
+            return {phase: histogram.summary() for phase, histogram in self.histograms.items()}
+
+    def print_summary(self):
+        print(f"{'phase':<10} {'count':>8} {'mean ms':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for phase, row in self.summary().items():
+            print(
+                f"{phase:<10} {row['count']:>8} {row['mean_ms']:>9} {row['p50_ms']:>9} "
+                f"{row['p90_ms']:>9} {row['p99_ms']:>9} {row['max_ms']:>9}"
+            )
+
+
+# shared by the resolvers and the HTTP pool unless they're given their own
+timings = Timings()
@@ -1,83 +1,176 @@
+import argparse
+import functools
+import multiprocessing
 import os
-import json
+
+from harcache import CACHE_FILE, ResultCache
+from harfile import is_har_file, iter_entries, strip_suffix
+from publicsuffix import default_list, domain_id, is_third_party, registrable_domain, url_host
+
+DIRECTORY = '/Users/adrianrivera/Desktop/EEC 173A (ECS 152)/Project 2/HAR_Files/'
+# most HAR files handed to a worker at once, it sends back one partial result per file
+BATCH_SIZE = 100
+BATCHES_PER_WORKER = 4
+# bump whenever process_har_file changes what it counts, so cached results are redone
+ANALYSIS_VERSION = 2
+
 
 # function to analyze HAR files
 # process a HAR file to extract third-party cookies and request details.
 def process_har_file(filename, cookie_store, request_counter, file_dir):
-    # read the HAR file
-    try:
-        with open(os.path.join(file_dir, filename), 'r', encoding='utf-8') as file:
-            har_data = json.load(file)
-
-    except (FileNotFoundError, json.JSONDecodeError):
-        print(f'Failed to load HAR file: {filename}')
-        return cookie_store, request_counter
-
-    # extract entries
-    entries = har_data.get('log', {}).get('entries', [])
     req_cookie_list, res_cookie_list, req_url_list = [], [], []
 
-    # process each entry
-    for entry in entries:
-        # request cookies
-        request = entry.get('request', {})
-        req_cookies = request.get('cookies', [])
-        req_url = request.get('url', "")
+    # read the HAR file one entry at a time (plain, gzip or zstd compressed, going by the file name),
+    # without response bodies. Only the lists above are filled while reading, so a file that turns
+    # out to be broken part way through leaves cookie_store and request_counter as they were
+    try:
+        for entry in iter_entries(os.path.join(file_dir, filename)):
+            # request cookies
+            request = entry.get('request', {})
+            req_cookies = request.get('cookies', [])
+            req_url = request.get('url', "")
 
-        for cookie in req_cookies:
+            for cookie in req_cookies:
 
-            if req_url:
-                req_cookie_list.append((req_url, cookie.get('name')))
-                req_url_list.append(req_url)
+                if req_url:
+                    req_cookie_list.append((req_url, cookie.get('name')))
+                    req_url_list.append(req_url)
 
-        # response cookies
-        response = entry.get('response', {})
-        res_cookies = response.get('cookies', [])
+            # response cookies
+            response = entry.get('response', {})
+            res_cookies = response.get('cookies', [])
 
-        for cookie in res_cookies:
+            for cookie in res_cookies:
 
-            domain = cookie.get('domain')
+                domain = cookie.get('domain')
 
-            if domain:
-                res_cookie_list.append((domain, cookie.get('name')))
+                if domain:
+                    res_cookie_list.append((domain, cookie.get('name')))
+
+    except (OSError, EOFError, ValueError):
+        print(f'Failed to load HAR file: {filename}')
+        return cookie_store, request_counter
 
     # combine request and response cookies
     combined_cookies = req_cookie_list + res_cookie_list
 
-    # extract domain name
-    common_domains = ['.com', '.net', '.org', '.edu', '.co', '.ru', '.uk', '.jp', '.io', '.it', '.br', '.cn']
-
-    underscore_pos = filename.find("_")
-    domain_end = next((filename.find(dom) for dom in common_domains if dom in filename), filename.rfind('.'))
-    site_name = filename[underscore_pos + 1:domain_end]
-
-    # add dot for small site names
-    if len(site_name) < 6:
-        site_name += '.'
+    # extract domain name: files are named <rank>_<site>.har, the site's registrable domain
+    # (eTLD+1, so www.bbc.co.uk is bbc.co.uk) is the first party
+    site_name = registrable_domain(strip_suffix(filename).partition("_")[2])
+    site_id = domain_id(site_name)
 
-    # count third-party requests
-    request_counter[site_name] = sum(1 for url in req_url_list if site_name not in url)
+    # count third-party requests, anything not under the site's registrable domain
+    request_counter[site_name] = sum(1 for url in req_url_list if is_third_party(url_host(url), site_id))
     print(f"Third-party requests for {site_name}: {request_counter[site_name]}")
 
     # update cookie counts
     for domain, name in combined_cookies:
 
-        if site_name not in domain:
+        # request cookies are listed under the request URL, response cookies under their domain
+        if is_third_party(url_host(domain) or domain, site_id):
             cookie_store.setdefault(domain, {}).setdefault(name, 0)
             cookie_store[domain][name] += 1
 
     return cookie_store, request_counter
 
 
-if __name__ == "__main__":
-    DIRECTORY = '/Users/adrianrivera/Desktop/EEC 173A (ECS 152)/Project 2/HAR_Files/'
-    har_files = os.listdir(DIRECTORY)
+def analyze_file(filename, file_dir):
+    """
+    Process one HAR file into a fresh cookie store and request counter, or
+    None if it couldn't be read. Cookie names are made strings (a missing
+    one is ""), as they'd come back from the cache's JSON anyway.
+    """
+    cookie_store, request_counter = process_har_file(filename, {}, {}, file_dir)
+    # every file that's read gets a request count, even one with no entries
+    if not request_counter:
+        return None
+    cookie_store = {domain: {"" if name is None else str(name): count for name, count in cookies.items()}
+                    for domain, cookies in cookie_store.items()}
+    return cookie_store, request_counter
 
-    cookie_store = {}
-    request_counter = {}
 
-    for har_file in har_files:
-        cookie_store, request_counter = process_har_file(har_file, cookie_store, request_counter, DIRECTORY)
+def analyze_files(filenames, file_dir):
+    """
+    Process a batch of HAR files: the partial results one worker sends
+    back, one per file, which are also what gets cached
+    """
+    return [analyze_file(filename, file_dir) for filename in filenames]
+
+
+def merge_results(cookie_store, request_counter, partial):
+    """
+    Add a partial result into the totals. Cookie counts add up and a site's
+    request count replaces any earlier one, as in process_har_file, so
+    merging partials in file order gives exactly the serial result however
+    the files were batched.
+    """
+    partial_cookies, partial_requests = partial
+    for domain, cookies in partial_cookies.items():
+        counts = cookie_store.setdefault(domain, {})
+        for name, count in cookies.items():
+            counts[name] = counts.get(name, 0) + count
+    request_counter.update(partial_requests)
+    return cookie_store, request_counter
+
+
+def analyze_directory(directory, workers=1, cache_file=CACHE_FILE):
+    """
+    Process every HAR file in directory, in batches spread over workers
+    processes. With a cache_file (relative to directory), files analyzed
+    by an earlier run and unchanged since aren't read again. Returns
+    (cookie_store, request_counter).
+    """
+    har_files = [name for name in os.listdir(directory) if is_har_file(name)]
+    # taken before any file is read, see ResultCache.store
+    stats = {name: os.stat(os.path.join(directory, name)) for name in har_files}
+
+    # results also depend on which public suffix rules (full list or BUILTIN_RULES) decided what's third party
+    version = f"{ANALYSIS_VERSION}:{default_list().digest}"
+    cache = ResultCache(os.path.join(directory, cache_file), version) if cache_file else None
+    partials = cache.fresh(stats) if cache else {}
+    todo = [name for name in har_files if name not in partials]
+    if cache:
+        print(f"{len(har_files) - len(todo)} HAR files unchanged since the last run, {len(todo)} to analyze")
+
+    # a few batches per worker so they finish at about the same time
+    batch_size = max(1, min(BATCH_SIZE, -(-len(todo) // (workers * BATCHES_PER_WORKER))))
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+
+    pool = multiprocessing.Pool(workers) if workers > 1 and len(batches) > 1 else None
+    try:
+        analyze = functools.partial(analyze_files, file_dir=directory)
+        # imap hands results back in batch order whichever worker finishes first
+        for batch, results in zip(batches, pool.imap(analyze, batches) if pool else map(analyze, batches)):
+            partials.update(zip(batch, results))
+            if cache:
+                # saved batch by batch, so an interrupted run keeps what it's done.
+                # Files that couldn't be read are tried again next time.
+                cache.store((name, stats[name], partials[name]) for name in batch if partials[name] is not None)
+    finally:
+        if pool:
+            pool.terminate()
+        if cache:
+            cache.prune(har_files)
+            cache.close()
+
+    # merged in directory order whichever files came from the cache, which
+    # gives exactly the result of analyzing them all in one go
+    cookie_store, request_counter = {}, {}
+    for name in har_files:
+        if partials[name] is not None:
+            merge_results(cookie_store, request_counter, partials[name])
+    return cookie_store, request_counter
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count third-party requests and cookies in a directory of HAR files")
+    parser.add_argument("directory", nargs="?", default=DIRECTORY)
+    parser.add_argument("--workers", type=int, default=1, help="processes to analyze files in, 0 for one per CPU")
+    parser.add_argument("--cache", default=CACHE_FILE, help="file in the HAR directory keeping each HAR's results between runs")
+    parser.add_argument("--no-cache", dest="cache", action="store_const", const=None, help="analyze every file, keeping nothing")
+    args = parser.parse_args(argv)
+
+    cookie_store, request_counter = analyze_directory(args.directory, args.workers or os.cpu_count(), args.cache)
 
     # Top 10 cookies summary
     top_cookies = sorted(((domain, name, count) for domain, cookies in cookie_store.items() for name, count in cookies.items()), key = lambda x: x[2], reverse = True)[:10]
@@ -92,3 +185,7 @@ if __name__ == "__main__":
     print('\nTop 10 Domains:')
     for domain, count in top_domains:
         print(f"{domain}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,84 +1,544 @@
 from browsermobproxy import Server
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException
+from crawljournal import JOURNAL_FILE, MAX_ATTEMPTS, CrawlJournal
+from harfile import SUFFIXES, write_har
+import argparse
+import array
+import collections
 import csv
-import json
-
-# create a browsermob server instance
-server = Server("browsermob-proxy/bin/browsermob-proxy")
-server.start()
-proxy = server.create_proxy(params=dict(trustAllServers=True))
-
-# create a new chromedriver instance
-chrome_options = webdriver.ChromeOptions()
-chrome_options.add_argument(f"--proxy-server={proxy.proxy}")
-chrome_options.add_argument('--ignore-certificate-errors')
-
-# these additional chrome options improve the performance of the crawling process
-chrome_options.add_argument('--disable-accelerated-2d-canvas')
-chrome_options.add_argument('--disable-software-rasterizer')
-chrome_options.add_argument('--disable-popup-blocking')
-chrome_options.add_argument('--disable-web-security')
-chrome_options.add_argument('--disable-gpu')
-chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-chrome_options.add_argument('--disable-logging')
-chrome_options.add_argument('--disable-extensions')
-chrome_options.add_argument('--disable-third-party-cookies=false')
-chrome_options.add_argument('--hide-scrollbars')
-chrome_options.add_argument('--headless')
-chrome_options.add_argument('--mute-audio')
-chrome_options.add_argument('--disable-background-networking')
-chrome_options.add_argument('--disable-sync')
-chrome_options.add_argument('--disable-default-apps')
-chrome_options.add_argument('--incognito')
-driver = webdriver.Chrome(options=chrome_options)
-
-# clear cookies before starting
-driver.delete_all_cookies()
-
-# directory path to place the generated HAR files 
+import itertools
+import multiprocessing
+import os
+import queue
+import time
+import urllib.parse
+
+BROWSERMOB_PATH = "browsermob-proxy/bin/browsermob-proxy"
+# each browser+proxy pair gets its own browsermob server on BROWSERMOB_PORT + PORT_STRIDE * index,
+# with its proxy on the port after it
+BROWSERMOB_PORT = 8080
+PORT_STRIDE = 10
+
+# directory path to place the generated HAR files
 HAR_DIRECTORY = '/Users/adrianrivera/Desktop/EEC 173A (ECS 152)/Project 2/HAR_Files/'
+SITES_FILE = "top-1m.csv"
+# where every INDEX_STRIDE-th row of the sites file starts, kept next to it as
+# <sites file>.index so a crawl starting deep into the list can seek there
+INDEX_SUFFIX = ".index"
+INDEX_STRIDE = 1000
+TARGET_SITES = 1000
+PAGE_LOAD_TIMEOUT = 120
+# a page counts as loaded once DOMContentLoaded has fired and nothing has gone
+# through the proxy for this long
+NETWORK_IDLE_MS = 2000
+# with enough load times to go on, sites get TIMEOUT_FACTOR times the 95th
+# percentile of them (but at least MIN_TIMEOUT), doubled for each earlier failure
+MIN_TIMEOUT = 15
+TIMEOUT_FACTOR = 3
+ADAPTIVE_MIN_SAMPLES = 20
+# visits before Chrome is restarted, memory use grows the longer one runs
+RESTART_EVERY = 100
+# sites handed out ahead of time per worker, so none of them waits on the parent
+TASKS_PER_WORKER = 2
+
+
+def chrome_options_for(proxy, eager=False):
+    chrome_options = webdriver.ChromeOptions()
+    if eager:
+        # driver.get returns at DOMContentLoaded rather than the load event
+        chrome_options.page_load_strategy = 'eager'
+    chrome_options.add_argument(f"--proxy-server={proxy.proxy}")
+    chrome_options.add_argument('--ignore-certificate-errors')
+
+    # these additional chrome options improve the performance of the crawling process
+    chrome_options.add_argument('--disable-accelerated-2d-canvas')
+    chrome_options.add_argument('--disable-software-rasterizer')
+    chrome_options.add_argument('--disable-popup-blocking')
+    chrome_options.add_argument('--disable-web-security')
+    chrome_options.add_argument('--disable-gpu')
+    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
+    chrome_options.add_argument('--disable-logging')
+    chrome_options.add_argument('--disable-extensions')
+    chrome_options.add_argument('--disable-third-party-cookies=false')
+    chrome_options.add_argument('--hide-scrollbars')
+    chrome_options.add_argument('--headless')
+    chrome_options.add_argument('--mute-audio')
+    chrome_options.add_argument('--disable-background-networking')
+    chrome_options.add_argument('--disable-sync')
+    chrome_options.add_argument('--disable-default-apps')
+    chrome_options.add_argument('--incognito')
+    return chrome_options
+
+
+class Browser:
+    """
+    One browsermob proxy and the headless Chrome that goes through it. Pairs
+    with different indexes use different ports, so several can run at once.
+
+    With isolation "clear", everything a site stored (cookies, cache, local
+    storage, IndexedDB, service workers) is wiped over the DevTools protocol
+    after its visit, so it can't show up in the next site's HAR, without
+    the cost of a new Chrome. Chrome is still restarted every restart_every
+    visits to put a bound on its memory use.
+    """
+
+    def __init__(self, index=0, har_directory=HAR_DIRECTORY, page_load_timeout=PAGE_LOAD_TIMEOUT,
+                 browsermob_path=BROWSERMOB_PATH, compression=None, strip_content=False,
+                 idle_ms=NETWORK_IDLE_MS, isolation="clear", restart_every=RESTART_EVERY):
+        self.index = index
+        self.idle_ms = idle_ms
+        self.isolation = isolation
+        self.restart_every = restart_every
+        self.har_directory = har_directory
+        self.compression = compression
+        self.strip_content = strip_content
+        self.page_load_timeout = page_load_timeout
+        self.browsermob_path = browsermob_path
+        self.server = None
+        self.proxy = None
+        self.driver = None
+        self.timeout = None
+        self.visits = 0
+        # set while Chrome is in an unknown state, the next visit starts a new one
+        self.broken = False
+
+    def start(self):
+        # create a browsermob server instance
+        port = BROWSERMOB_PORT + PORT_STRIDE * self.index
+        self.server = Server(self.browsermob_path, options={'port': port})
+        self.server.start()
+        self.proxy = self.server.create_proxy(params=dict(trustAllServers=True, port=port + 1))
+        self.start_driver()
+
+    def start_driver(self):
+        # create a new chromedriver instance
+        self.driver = webdriver.Chrome(options=chrome_options_for(self.proxy, eager=self.idle_ms > 0))
+        # clear cookies before starting
+        self.driver.delete_all_cookies()
+        self.timeout = None
+        self.set_timeout(self.page_load_timeout)
+        self.visits = 0
+        self.broken = False
+
+    def restart_driver(self):
+        # stays set if the new Chrome doesn't start
+        self.broken = True
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+        self.start_driver()
+
+    def set_timeout(self, timeout):
+        if timeout != self.timeout:
+            self.driver.set_page_load_timeout(timeout)
+            self.timeout = timeout
+
+    def visit(self, rank, site_name, timeout=None):
+        """
+        Load one site and save its HAR. Returns (status, detail, seconds):
+        ("success", HAR path, load time), ("timeout", HAR path of what was
+        captured before the deadline or None, time) or ("error", message,
+        time).
+        """
+        har_path = f"{self.har_directory}{rank}_{site_name}{SUFFIXES[self.compression]}"
+        start_time = time.monotonic()
+        har = None
+        try:
+            if self.broken or (self.restart_every and self.visits >= self.restart_every):
+                self.restart_driver()
+            self.visits += 1
+            self.set_timeout(timeout or self.page_load_timeout)
+            # a Chrome restart doesn't count towards the load time
+            start_time = time.monotonic()
+            self.proxy.new_har(site_name, options={'captureHeaders': True, 'captureCookies': True})
+
+            # attempt to visit the site
+            self.driver.get("http://" + site_name)
+            if self.idle_ms:
+                # wait out the requests still going after DOMContentLoaded, up to the deadline
+                remaining = self.timeout - (time.monotonic() - start_time)
+                self.proxy.wait_for_traffic_to_stop(self.idle_ms, max(0, int(remaining * 1000)))
+            seconds = time.monotonic() - start_time
+
+            # write har file
+            har = self.proxy.har
+            write_har(har, har_path, self.strip_content)
+            return "success", har_path, seconds
+
+        except TimeoutException:
+            seconds = time.monotonic() - start_time
+            # keep the traffic captured so far rather than throwing it away. The
+            # HAR comes from the proxy, so it's saved first: a renderer that's hung
+            # is what most often makes window.stop() fail
+            try:
+                har = self.proxy.har
+                write_har(har, har_path, self.strip_content)
+            except Exception:
+                har_path = None
+            try:
+                self.driver.execute_script("window.stop();")
+            except Exception:
+                pass
+            return "timeout", har_path, seconds
+
+        except Exception as error_loading:
+            return "error", str(error_loading), time.monotonic() - start_time
+
+        finally:
+            if self.isolation == "clear" and not self.broken:
+                try:
+                    self.reset_state(site_name, har)
+                except Exception as error:
+                    # the visit's outcome stands, the next one retries the restart
+                    print(f'Could not reset the browser after {site_name}: {error}')
+
+    def reset_state(self, site_name, har=None):
+        """
+        Wipe what the last visit left in the browser: cookies and cache for
+        every site, and the other storage of each origin the visit talked to.
+        If that fails the browser is restarted instead.
+        """
+        origins = har_origins(har) if har is not None else set()
+        for host in (site_name, "www." + site_name):
+            origins.update((f"http://{host}", f"https://{host}"))
+        try:
+            # leave the page first so nothing it runs writes anything back
+            self.driver.get("about:blank")
+            self.driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+            self.driver.execute_cdp_cmd("Network.clearBrowserCache", {})
+            for origin in origins:
+                self.driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        except Exception:
+            self.restart_driver()
+
+    def stop(self):
+        # stop server and exit
+        if self.server is not None:
+            self.server.stop()
+        if self.driver is not None:
+            self.driver.quit()
+
+
+def har_origins(har):
+    """
+    The scheme://host[:port] origins of the requests in a HAR
+    """
+    origins = set()
+    for entry in har.get("log", {}).get("entries", []):
+        parts = urllib.parse.urlsplit(entry.get("request", {}).get("url", ""))
+        if parts.scheme and parts.netloc:
+            origins.add(f"{parts.scheme}://{parts.netloc.rpartition('@')[2]}")
+    return origins
+
 
-driver.set_page_load_timeout(120)
+def row_offsets(sites_file, stride=INDEX_STRIDE):
+    """
+    Byte offsets of rows 1, stride + 1, 2 * stride + 1, ... of sites_file.
+    They're kept in sites_file + INDEX_SUFFIX, which is rebuilt (one pass
+    over the file) when the file's size or modification time changes.
+    """
+    stat = os.stat(sites_file)
+    header = [stat.st_size, stat.st_mtime_ns, stride]
+    index_file = sites_file + INDEX_SUFFIX
+    offsets = array.array("q")
+    try:
+        with open(index_file, "rb") as file:
+            offsets.frombytes(file.read())
+        if offsets[:3].tolist() == header:
+            return offsets[3:]
+    except (OSError, ValueError):
+        pass
+
+    offsets = array.array("q", header)
+    position = 0
+    with open(sites_file, "rb") as file:
+        for row, line in enumerate(file):
+            if row % stride == 0:
+                offsets.append(position)
+            position += len(line)
+    try:
+        with open(index_file + ".part", "wb") as file:
+            offsets.tofile(file)
+        os.replace(index_file + ".part", index_file)
+    except OSError as e:
+        # e.g. a read-only directory, the next run just builds it again
+        print(f"Could not save {index_file}: {e}")
+    return offsets[3:]
+
+
+def read_sites(sites_file=SITES_FILE, start=1, stop=None, shard=0, shards=1):
+    """
+    Lazily yield (rank, site name) for the rows of the top sites list with
+    start <= rank < stop (rank is the 1-based row number), keeping only
+    those with rank % shards == shard. Rows are read as they're asked for
+    and skipped ones aren't parsed. A start past the first INDEX_STRIDE
+    rows seeks there through row_offsets, so once the index exists at most
+    INDEX_STRIDE rows are read before the first site.
+    """
+    with open(sites_file, "rb") as file:
+        skip = start - 1
+        if skip >= INDEX_STRIDE:
+            offsets = row_offsets(sites_file)
+            block = min(skip // INDEX_STRIDE, len(offsets) - 1)
+            if block > 0:
+                file.seek(offsets[block])
+                skip -= block * INDEX_STRIDE
+        lines = itertools.islice(file, skip, None if stop is None else skip + max(0, stop - start))
+        for rank, line in enumerate(lines, start):
+            if rank % shards != shard:
+                continue
+            row = next(csv.reader([line.decode("utf-8")], delimiter=","), None)
+            if row and len(row) > 1:
+                yield rank, row[1]
+
+
+def parse_shard(text):
+    """
+    Parse "i/N" into (i, N)
+    """
+    shard, _, shards = text.partition("/")
+    shard, shards = int(shard), int(shards or 1)
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError(f"shard {text!r} isn't of the form i/N with 0 <= i < N")
+    return shard, shards
+
+
+class AdaptiveTimeout:
+    """
+    Page load timeouts from the load times of earlier visits in the journal.
+    Until there are enough of them (or without adaptive) every site gets
+    max_timeout. A site that has failed before gets twice as long for each
+    failure, up to max_timeout.
+    """
+
+    def __init__(self, journal, max_timeout=PAGE_LOAD_TIMEOUT, adaptive=True):
+        self.journal = journal
+        self.max_timeout = max_timeout
+        self.adaptive = adaptive
+
+    def base_timeout(self):
+        if not self.adaptive:
+            return self.max_timeout
+        load_times = sorted(self.journal.load_times)
+        if len(load_times) < ADAPTIVE_MIN_SAMPLES:
+            return self.max_timeout
+        slow = load_times[min(len(load_times) - 1, int(0.95 * len(load_times)))]
+        return max(MIN_TIMEOUT, TIMEOUT_FACTOR * slow)
+
+    def timeout_for(self, rank):
+        retries = self.journal.attempts.get(rank, 0)
+        return min(self.max_timeout, round(self.base_timeout() * 2 ** retries))
 
-# read the csv file
-with open("top-1m.csv", newline="") as file:
-    sites_from_csv = list(csv.reader(file, delimiter=","))
 
-# variables to track crawling process
-current_site_index = 0
-sites_succesfully_visted = 0
-sites_unseccesfully_visited = 0
+class CrawlTally:
+    """
+    Counts outcomes, prints one line per site and writes each outcome to
+    the journal (if there is one). Successes from earlier runs in the
+    journal count towards the target.
+    """
 
-while sites_succesfully_visted < 1000:
+    def __init__(self, journal=None):
+        self.journal = journal
+        self.succeeded = journal.succeeded if journal is not None else 0
+        self.failed = 0
+
+    def record(self, rank, site_name, status, detail, seconds=None):
+        if self.journal is not None:
+            self.journal.record(rank, site_name, status, detail, seconds)
+        if status == "success":
+            self.succeeded += 1
+            print(f'Visited: {site_name}')
+        elif status == "timeout":
+            self.failed += 1
+            print(f'Timeout for site {site_name}' + (' (partial HAR saved)' if detail else ''))
+        else:
+            self.failed += 1
+            print(f'Error visiting {site_name}: {detail}')
+
+
+def crawl_serial(sites, target, tally, timeouts, **browser_options):
+    """
+    Visit sites one at a time in this process until target of them succeed
+    """
+    browser = Browser(**browser_options)
+    try:
+        browser.start()
+        for rank, site_name in sites:
+            if tally.succeeded >= target:
+                break
+            tally.record(rank, site_name, *browser.visit(rank, site_name, timeouts.timeout_for(rank)))
+    finally:
+        browser.stop()
+
+
+def crawl_worker(index, tasks, results, browser_options):
+    """
+    Run one browser+proxy pair, taking (rank, site, timeout) tasks from its
+    own queue until it gets None and putting (index, rank, site, status,
+    detail, seconds) on results. ("exit", index, visiting) is the last thing
+    each worker puts, visiting saying whether it stopped in the middle of a visit.
+    """
+    browser = Browser(index, **browser_options)
+    visiting = False
     try:
-        # do crawling
-        site_name = sites_from_csv[current_site_index][1]
-        proxy.new_har(site_name, options={'captureHeaders': True, 'captureCookies': True})
+        browser.start()
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            rank, site_name, timeout = task
+            visiting = True
+            results.put((index, rank, site_name) + browser.visit(rank, site_name, timeout))
+            visiting = False
+    except KeyboardInterrupt:
+        pass
+    except Exception as error:
+        print(f'Worker {index} stopped: {error}')
+    finally:
+        try:
+            browser.stop()
+        finally:
+            results.put(("exit", index, visiting))
 
-        # attempt to visit the site
-        driver.get("http://" + site_name)
 
-        # write har file
-        with open(f"{HAR_DIRECTORY}{current_site_index + 1}_{site_name}.har", "w") as f:
-            f.write(json.dumps(proxy.har))
+def crawl_parallel(sites, target, tally, timeouts, workers, **browser_options):
+    """
+    Visit sites with workers browser+proxy pairs, each in its own process.
+    Each worker has its own queue of a few sites at a time, so it's known
+    which sites a worker had when it stops. Sites stop going out once the
+    ones finished or in flight would reach target.
+    """
+    task_queues = [multiprocessing.Queue() for _ in range(workers)]
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=crawl_worker, args=(index, task_queues[index], results, browser_options),
+                                daemon=True)
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
 
-        sites_succesfully_visted += 1  
-        print(f'Visited: {site_name}')
+    sites = iter(sites)
+    # the (rank, site) tasks given to each worker still running, oldest
+    # first: a worker visits them in order, so the first is the one it's on
+    assigned = {index: collections.deque() for index in range(workers)}
+    # tasks taken back from workers that stopped, sent out again before new ones
+    returned = collections.deque()
 
-    except TimeoutException:
-        print(f'Timeout for site {sites_from_csv[current_site_index][1]}')
-        sites_unseccesfully_visited += 1 
+    def worker_stopped(index, visiting=True):
+        held = assigned.pop(index, None)
+        if held and visiting:
+            # the site may be what broke it, so it isn't handed to another worker
+            rank, site_name = held.popleft()
+            tally.record(rank, site_name, "error", f"worker {index} stopped during the visit")
+        returned.extend(held or ())
 
-    except Exception as error_loading:
-        print(f'Error visiting {sites_from_csv[current_site_index][1]}: {error_loading}')
-        sites_unseccesfully_visited += 1  
+    try:
+        while assigned:
+            # keep every worker busy without handing out more than target needs
+            in_flight = sum(len(held) for held in assigned.values())
+            for index, held in assigned.items():
+                while len(held) < TASKS_PER_WORKER and tally.succeeded + in_flight < target:
+                    task = returned.popleft() if returned else next(sites, None)
+                    if task is None:
+                        break
+                    task_queues[index].put(task + (timeouts.timeout_for(task[0]),))
+                    held.append(task)
+                    in_flight += 1
+            if not in_flight:
+                break
+
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                # a worker killed outright never says it's exiting; with nothing
+                # left to read, anything it had finished has been recorded
+                for index in [index for index in assigned if not processes[index].is_alive()]:
+                    worker_stopped(index)
+                continue
+            if result[0] == "exit":
+                worker_stopped(result[1], result[2])
+                continue
+            held = assigned.get(result[0])
+            if held:
+                held.popleft()
+                tally.record(*result[1:])
+    finally:
+        for task_queue in task_queues:
+            task_queue.put(None)
+        # one deadline for all of them, not one each
+        deadline = time.monotonic() + PAGE_LOAD_TIMEOUT
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+        # drain so the queues' feeder threads can exit
+        while True:
+            try:
+                results.get_nowait()
+            except queue.Empty:
+                break
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Visit the top sites and save a HAR file for each")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="browser+proxy pairs to run at once, each in its own process")
+    parser.add_argument("--target", type=int, default=TARGET_SITES, help="sites to visit successfully")
+    parser.add_argument("--sites-file", default=SITES_FILE)
+    parser.add_argument("--start", type=int, default=1, help="first rank to crawl")
+    parser.add_argument("--stop", type=int, default=None, help="rank to stop before")
+    parser.add_argument("--shard", type=parse_shard, default=(0, 1),
+                        help="i/N: only crawl the ranks equal to i modulo N, for splitting a crawl between machines")
+    parser.add_argument("--har-directory", default=HAR_DIRECTORY)
+    parser.add_argument("--timeout", type=int, default=PAGE_LOAD_TIMEOUT,
+                        help="longest page load timeout in seconds, shorter ones are derived from earlier load times")
+    parser.add_argument("--fixed-timeout", action="store_true", help="give every site the full --timeout")
+    parser.add_argument("--idle-ms", type=int, default=NETWORK_IDLE_MS,
+                        help="finish a visit once DOMContentLoaded has fired and the network has been quiet this "
+                             "long, 0 waits for the load event instead")
+    parser.add_argument("--browsermob", default=BROWSERMOB_PATH, help="path to the browsermob-proxy script")
+    parser.add_argument("--isolation", choices=["clear", "none"], default="clear",
+                        help="clear: wipe cookies, cache and site storage over DevTools after every visit; "
+                             "none: share one session between all sites")
+    parser.add_argument("--restart-every", type=int, default=RESTART_EVERY,
+                        help="restart Chrome after this many visits, 0 never does")
+    parser.add_argument("--compress", choices=["gzip", "zstd"], default=None, help="compress the HAR files")
+    parser.add_argument("--strip-content", action="store_true",
+                        help="leave response bodies out of the HAR files, the analysis doesn't use them")
+    parser.add_argument("--journal", default=JOURNAL_FILE,
+                        help="file logging each site's outcome, a restarted crawl skips the sites done in it")
+    parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS,
+                        help="visits a failing site gets across restarts")
+    args = parser.parse_args(argv)
+
+    browser_options = dict(har_directory=args.har_directory, page_load_timeout=args.timeout,
+                           browsermob_path=args.browsermob, compression=args.compress,
+                           strip_content=args.strip_content, idle_ms=args.idle_ms,
+                           isolation=args.isolation, restart_every=args.restart_every)
+    journal = CrawlJournal(args.journal)
+    if journal.succeeded:
+        print(f'Resuming with {journal.succeeded} sites already visited')
+    tally = CrawlTally(journal)
+    timeouts = AdaptiveTimeout(journal, args.timeout, adaptive=not args.fixed_timeout)
+    shard, shards = args.shard
+    sites = read_sites(args.sites_file, args.start, args.stop, shard, shards)
+    sites = journal.pending(sites, args.max_attempts)
+    try:
+        if args.workers > 1:
+            crawl_parallel(sites, args.target, tally, timeouts, args.workers, **browser_options)
+        else:
+            crawl_serial(sites, args.target, tally, timeouts, **browser_options)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        journal.close()
 
-    current_site_index += 1
+    # summary of crawling results
+    print(f'{tally.succeeded} sites visited successfully and {tally.failed} sites unfortunately failed.')
 
-# stop server and exit
-server.stop()
-driver.quit()
 
-# summary of crawling results
-print(f'{sites_succesfully_visted} sites visited successfully and {sites_unseccesfully_visited} sites unfortunately failed.')
+if __name__ == "__main__":
+    main()
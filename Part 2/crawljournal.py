@@ -0,0 +1,90 @@
+import collections
+import json
+import os
+import time
+
+JOURNAL_FILE = "crawl_journal.jsonl"
+# visits a site gets across all runs before it's given up on
+MAX_ATTEMPTS = 3
+# load times of the most recent successful visits kept for adapting timeouts
+LOAD_TIME_SAMPLES = 200
+
+
+class CrawlJournal:
+    """
+    Append-only log of site outcomes, one JSON line per visit, synced to disk
+    as each one is written so a crash loses at most the site being visited.
+    Reading it back tells a restarted crawl which sites are done and how
+    often the others have failed.
+    """
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.completed = {}
+        self.attempts = {}
+        self.load_times = collections.deque(maxlen=LOAD_TIME_SAMPLES)
+        self.load()
+        self.file = open(path, "a", encoding="utf-8")
+        if self.file.tell() and not self.ends_with_newline():
+            # the last line was cut off mid-write
+            self.file.write("\n")
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.apply(entry)
+
+    def apply(self, entry):
+        rank = entry["rank"]
+        self.attempts[rank] = self.attempts.get(rank, 0) + 1
+        if entry["status"] == "success":
+            self.completed[rank] = entry["har"]
+            if entry.get("seconds") is not None:
+                self.load_times.append(entry["seconds"])
+
+    def ends_with_newline(self):
+        with open(self.path, "rb") as file:
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) == b"\n"
+
+    def record(self, rank, site_name, status, detail, seconds=None):
+        """
+        Log one visit. detail is the HAR path for a success or a timeout
+        (whose partial HAR was saved) and the error message otherwise.
+        """
+        entry = {"rank": rank, "site": site_name, "status": status, "time": round(time.time(), 3)}
+        if seconds is not None:
+            entry["seconds"] = round(seconds, 3)
+        if status in ("success", "timeout"):
+            if detail:
+                entry["har"] = detail
+        elif detail:
+            entry["error"] = detail
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.apply(entry)
+
+    @property
+    def succeeded(self):
+        return len(self.completed)
+
+    def should_visit(self, rank, max_attempts=MAX_ATTEMPTS):
+        return rank not in self.completed and self.attempts.get(rank, 0) < max_attempts
+
+    def pending(self, sites, max_attempts=MAX_ATTEMPTS):
+        """
+        Yield the (rank, site) pairs from sites that still need a visit
+        """
+        for rank, site_name in sites:
+            if self.should_visit(rank, max_attempts):
+                yield rank, site_name
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,60 @@
+import json
+import sqlite3
+
+# kept in the HAR directory, so it moves with the files it describes
+CACHE_FILE = ".har_analysis_cache.sqlite"
+
+
+class ResultCache:
+    """
+    Per-file analysis results in SQLite, keyed by HAR file name. A result
+    is reused while the file's size and modification time are what they
+    were when it was analyzed and the analysis version (any string) hasn't
+    changed.
+    Results are stored as JSON.
+    """
+
+    def __init__(self, path, version):
+        self.version = version
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, version TEXT, result TEXT)"
+        )
+
+    def fresh(self, stats):
+        """
+        The cached results for the files in stats ({name: os.stat_result})
+        that haven't changed since, as {name: result}
+        """
+        results = {}
+        rows = self.connection.execute("SELECT name, size, mtime_ns, result FROM results WHERE version = ?", (self.version,))
+        for name, size, mtime_ns, result in rows:
+            stat = stats.get(name)
+            if stat is not None and stat.st_size == size and stat.st_mtime_ns == mtime_ns:
+                results[name] = json.loads(result)
+        return results
+
+    def store(self, items):
+        """
+        Save (name, stat, result) items. stat should be taken before the file
+        is read, so a file that changes while it's analyzed is redone next time.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                ((name, stat.st_size, stat.st_mtime_ns, self.version, json.dumps(result)) for name, stat, result in items),
+            )
+
+    def prune(self, names):
+        """
+        Forget every file not in names
+        """
+        names = set(names)
+        gone = [(name,) for (name,) in self.connection.execute("SELECT name FROM results") if name not in names]
+        with self.connection:
+            self.connection.executemany("DELETE FROM results WHERE name = ?", gone)
+        return len(gone)
+
+    def close(self):
+        self.connection.close()
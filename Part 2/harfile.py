@@ -0,0 +1,312 @@
+import gzip
+import json
+import os
+import re
+from json.decoder import scanstring
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# file name endings for each compression, HAR files are named <rank>_<site><suffix>
+SUFFIXES = {None: ".har", "gzip": ".har.gz", "zstd": ".har.zst"}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# text read at a time when scanning a HAR
+CHUNK_SIZE = 1 << 18
+
+# a "text" key followed by a string: a response or POST body
+BODY_KEY = re.compile(r'"text"\s*:\s*"')
+# text held back at the end of each chunk in case a body key straddles two
+BODY_KEY_TAIL = 256
+WHITESPACE = re.compile(r'\s*')
+
+
+def compression_for(path):
+    """
+    The compression a HAR path's name says it uses
+    """
+    for compression, suffix in SUFFIXES.items():
+        if compression and path.endswith(suffix):
+            return compression
+    return None
+
+
+def is_har_file(name):
+    return any(name.endswith(suffix) for suffix in SUFFIXES.values())
+
+
+def strip_suffix(name):
+    """
+    Take the .har, .har.gz or .har.zst off a file name
+    """
+    for suffix in sorted(SUFFIXES.values(), key=len, reverse=True):
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def open_har(path, mode="r", compression=None):
+    """
+    Open a HAR file as text, compressed or not. mode is "r" or "w".
+    """
+    if compression == "gzip":
+        if mode == "w":
+            return gzip.open(path, "wt", encoding="utf-8", compresslevel=GZIP_LEVEL)
+        return gzip.open(path, "rt", encoding="utf-8")
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compressed HAR files need the zstandard package")
+        if mode == "w":
+            return zstandard.open(path, "w", cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL), encoding="utf-8")
+        return zstandard.open(path, "r", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def without_bodies(file, chunk_size=CHUNK_SIZE):
+    r"""
+    Yield the JSON text read from file in pieces, with every "text" value
+    (the response and POST bodies) replaced by "". Bodies are only scanned
+    for where they end, one at a time, and never reach the parsed entries.
+    Something that only looks like a body key inside a string is left alone:
+
+    >>> import io
+    >>> print("".join(without_bodies(io.StringIO(r'{"a\"text\": \"text": " "}'))))
+    {"a\"text\": \"text": " "}
+    """
+    buffer = ""
+    # backslashes at the end of the text already yielded, an odd number of
+    # them escapes a quote at the start of buffer
+    backslashes = 0
+    while True:
+        data = file.read(chunk_size)
+        buffer += data
+        # pos is where the text not yet yielded starts, search where to look
+        # for the next body key
+        pos = search = 0
+        while True:
+            match = BODY_KEY.search(buffer, search)
+            if match is None:
+                break
+            start = index = match.start()
+            while index > 0 and buffer[index - 1] == "\\":
+                index -= 1
+            if (start - index + (backslashes if index == 0 else 0)) % 2:
+                # an escaped quote inside some string, not a key
+                search = start + 1
+                continue
+
+            yield buffer[pos : match.end()]
+            # pass over the body with the C string scanner (the fastest way to
+            # find where a JSON string ends), reading on until all of it is here
+            start = match.end()
+            while True:
+                try:
+                    end = scanstring(buffer, start, False)[1]
+                    break
+                except json.JSONDecodeError:
+                    more = file.read(max(chunk_size, len(buffer) - start))
+                    if not more:
+                        raise ValueError("HAR file ends in the middle of a string")
+                    buffer = buffer[start:] + more
+                    start = 0
+            yield '"'
+            pos = search = end
+
+        if not data:
+            yield buffer[pos:]
+            return
+        # hold back a tail in case a body key starts in it
+        keep = max(pos, len(buffer) - BODY_KEY_TAIL)
+        flushed = buffer[pos:keep]
+        if flushed:
+            stripped = flushed.rstrip("\\")
+            run = len(flushed) - len(stripped)
+            backslashes = run + backslashes if not stripped and pos == 0 else run
+            yield flushed
+        buffer = buffer[keep:]
+
+
+class EntryReader:
+    """
+    Walks down to log.entries in HAR text and parses the entries one at a
+    time with the C JSON decoder, reading text from pieces only as it's
+    needed. Together with without_bodies this keeps memory use down to
+    about one entry, however big the HAR.
+    """
+
+    def __init__(self, pieces, chunk_size=CHUNK_SIZE):
+        self.pieces = iter(pieces)
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def more(self):
+        """
+        Add at least chunk_size more text to the buffer. Returns False at
+        the end.
+        """
+        new = []
+        length = 0
+        for piece in self.pieces:
+            new.append(piece)
+            length += len(piece)
+            if length >= self.chunk_size:
+                break
+        else:
+            self.eof = True
+        self.buffer = self.buffer[self.pos :] + "".join(new)
+        self.pos = 0
+        return bool(length)
+
+    def peek(self):
+        """
+        The next character that isn't whitespace, "" at the end
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.more():
+                return self.buffer[self.pos : self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"expected {char!r} in HAR at {self.buffer[self.pos : self.pos + 20]!r}")
+        self.pos += 1
+
+    def value(self):
+        while True:
+            self.peek()
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof or not self.more():
+                    raise
+                continue
+            # a number at the very end might have more digits still to come
+            if end == len(self.buffer) and not self.eof and self.more():
+                continue
+            self.pos = end
+            return value
+
+    def members(self, close):
+        """
+        Step through the rest of an object (close "}", yielding each key with
+        the position just past its colon) or an array (close "]", yielding
+        None before each item)
+        """
+        first = True
+        while True:
+            char = self.peek()
+            if char == close:
+                self.pos += 1
+                return
+            if not first:
+                self.expect(",")
+            first = False
+            if close == "}":
+                key = self.value()
+                self.expect(":")
+                yield key
+            else:
+                yield None
+
+    def __iter__(self):
+        self.expect("{")
+        for key in self.members("}"):
+            if key != "log":
+                self.value()
+                continue
+            self.expect("{")
+            for key in self.members("}"):
+                if key != "entries":
+                    self.value()
+                    continue
+                self.expect("[")
+                for _ in self.members("]"):
+                    yield self.value()
+                return
+            return
+
+
+def iter_entries(path):
+    """
+    Yield the entries of a HAR file one at a time, without their response
+    bodies, whatever its compression
+    """
+    with open_har(path, "r", compression_for(path)) as file:
+        yield from EntryReader(without_bodies(file))
+
+
+def strip_entry(entry):
+    """
+    Drop the response body from an entry, keeping its size and type
+    """
+    content = entry.get("response", {}).get("content")
+    if content:
+        content.pop("text", None)
+        content.pop("encoding", None)
+    return entry
+
+
+class HARWriter:
+    """
+    Writes a HAR file one entry at a time instead of serializing the whole
+    thing into one string first. The file is written under a temporary
+    name and only moved into place by close(), so a HAR that exists is
+    always complete.
+    """
+
+    def __init__(self, path, log=None, strip_content=False):
+        self.path = path
+        self.temp_path = path + ".part"
+        self.strip_content = strip_content
+        self.entries = 0
+        self.file = open_har(self.temp_path, "w", compression_for(path))
+
+        # everything in log but the entries goes out first
+        header = {key: value for key, value in (log or {}).items() if key != "entries"}
+        opening = json.dumps(header)[:-1]
+        self.file.write('{"log": ' + opening + (', ' if header else '') + '"entries": [')
+
+    def write_entry(self, entry):
+        if self.strip_content:
+            entry = strip_entry(entry)
+        if self.entries:
+            self.file.write(",\n")
+        else:
+            self.file.write("\n")
+        self.file.write(json.dumps(entry))
+        self.entries += 1
+
+    def close(self):
+        self.file.write("\n]}}\n")
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_har(har, path, strip_content=False):
+    """
+    Write a HAR (as returned by the proxy) to path, compressed as its name
+    says. Returns the number of entries written.
+    """
+    log = har.get("log", {})
+    with HARWriter(path, log, strip_content) as writer:
+        for entry in log.get("entries", []):
+            writer.write_entry(entry)
+    return writer.entries
@@ -0,0 +1,335 @@
+import argparse
+import array
+import json
+import os
+import shutil
+import sys
+import time
+
+from harfile import is_har_file, iter_entries, strip_suffix
+from publicsuffix import domain_id, is_third_party, registrable_domain, url_host
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TABLE_DIRECTORY = "har_table"
+META_FILE = "meta.json"
+
+# one value per request: an array typecode, or "str" for strings stored as
+# codes into a dictionary of the column's distinct values
+COLUMNS = {
+    "rank": "i",
+    "site": "str",
+    "host": "str",
+    "domain": "str",
+    "third_party": "B",
+    "method": "str",
+    "status": "i",
+    "mime_type": "str",
+    # sizes and timings are -1 where the HAR says they're unknown or don't apply
+    "request_headers_size": "q",
+    "request_body_size": "q",
+    "response_headers_size": "q",
+    "response_body_size": "q",
+    "content_size": "q",
+    "time": "f",
+    "blocked": "f",
+    "dns": "f",
+    "connect": "f",
+    "ssl": "f",
+    "send": "f",
+    "wait": "f",
+    "receive": "f",
+}
+TIMINGS = ("blocked", "dns", "connect", "ssl", "send", "wait", "receive")
+# a list of strings per request, stored as dictionary codes for all the rows
+# one after another plus where each row's list starts (as Arrow does)
+LIST_COLUMNS = ("request_cookies", "response_cookies", "response_cookie_domains")
+
+
+def number(value):
+    return value if isinstance(value, (int, float)) else -1
+
+
+class TableBuilder:
+    """
+    Flattens HAR entries into columns, one row per request
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.columns = {name: array.array("i" if kind == "str" else kind) for name, kind in COLUMNS.items()}
+        self.lists = {name: (array.array("i"), array.array("q", [0])) for name in LIST_COLUMNS}
+        # value -> code, in code order
+        self.dictionaries = {name: {} for name, kind in COLUMNS.items() if kind == "str"}
+        self.dictionaries.update((name, {}) for name in LIST_COLUMNS)
+
+    def code(self, column, value):
+        codes = self.dictionaries[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+        return code
+
+    def add_entry(self, rank, site_name, site_id, entry):
+        request = entry.get("request", {})
+        response = entry.get("response", {})
+        content = response.get("content", {})
+        timings = entry.get("timings", {})
+        host = url_host(request.get("url", ""))
+
+        row = {
+            "rank": rank,
+            "site": self.code("site", site_name),
+            "host": self.code("host", host),
+            "domain": self.code("domain", registrable_domain(host)),
+            "third_party": is_third_party(host, site_id),
+            "method": self.code("method", request.get("method", "")),
+            "status": int(number(response.get("status"))),
+            "mime_type": self.code("mime_type", content.get("mimeType", "")),
+            "request_headers_size": int(number(request.get("headersSize"))),
+            "request_body_size": int(number(request.get("bodySize"))),
+            "response_headers_size": int(number(response.get("headersSize"))),
+            "response_body_size": int(number(response.get("bodySize"))),
+            "content_size": int(number(content.get("size"))),
+            "time": number(entry.get("time")),
+        }
+        for timing in TIMINGS:
+            row[timing] = number(timings.get(timing))
+        for name, value in row.items():
+            self.columns[name].append(value)
+
+        response_cookies = response.get("cookies", [])
+        self.add_list("request_cookies", (cookie.get("name", "") for cookie in request.get("cookies", [])))
+        self.add_list("response_cookies", (cookie.get("name", "") for cookie in response_cookies))
+        self.add_list("response_cookie_domains", (cookie.get("domain") or host for cookie in response_cookies))
+        self.rows += 1
+
+    def add_list(self, column, items):
+        values, offsets = self.lists[column]
+        values.extend(self.code(column, item) for item in items)
+        offsets.append(len(values))
+
+    def add_file(self, path, rank, site_name):
+        """
+        Add every entry of a HAR file. A file that can't be read adds
+        nothing, not even the entries before the problem.
+        """
+        site_id = domain_id(site_name)
+        rows = self.rows
+        try:
+            for entry in iter_entries(path):
+                self.add_entry(rank, site_name, site_id, entry)
+        except (OSError, EOFError, ValueError):
+            self.truncate(rows)
+            raise
+
+    def truncate(self, rows):
+        for column in self.columns.values():
+            del column[rows:]
+        for values, offsets in self.lists.values():
+            del offsets[rows + 1:]
+            del values[offsets[-1]:]
+        self.rows = rows
+
+    def save(self, directory):
+        """
+        Write the table as one raw array file per column plus META_FILE
+        with the column types and dictionaries. It's written next to
+        directory and swapped in at the end, replacing any older table.
+        """
+        temp = directory.rstrip(os.sep) + ".part"
+        shutil.rmtree(temp, ignore_errors=True)
+        os.makedirs(temp)
+
+        meta = {"rows": self.rows, "byteorder": sys.byteorder, "columns": {}}
+        for name, column in self.columns.items():
+            with open(os.path.join(temp, name + ".bin"), "wb") as file:
+                column.tofile(file)
+            meta["columns"][name] = {"type": column.typecode}
+        for name, (values, offsets) in self.lists.items():
+            with open(os.path.join(temp, name + ".bin"), "wb") as file:
+                values.tofile(file)
+            with open(os.path.join(temp, name + ".offsets.bin"), "wb") as file:
+                offsets.tofile(file)
+            meta["columns"][name] = {"type": values.typecode, "list": True}
+        for name, codes in self.dictionaries.items():
+            meta["columns"][name]["dictionary"] = list(codes)
+        with open(os.path.join(temp, META_FILE), "w", encoding="utf-8") as file:
+            json.dump(meta, file)
+
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(temp, directory)
+
+
+def ingest(har_directory, table_directory=TABLE_DIRECTORY):
+    """
+    Flatten every HAR file in har_directory into a table. Returns the
+    number of rows.
+    """
+    builder = TableBuilder()
+    for filename in sorted(name for name in os.listdir(har_directory) if is_har_file(name)):
+        # files are named <rank>_<site>.har
+        rank, _, site = strip_suffix(filename).partition("_")
+        try:
+            builder.add_file(os.path.join(har_directory, filename), int(rank) if rank.isdigit() else -1,
+                             registrable_domain(site))
+        except (OSError, EOFError, ValueError):
+            print(f"Failed to load HAR file: {filename}")
+    builder.save(table_directory)
+    return builder.rows
+
+
+class HARTable:
+    """
+    A table written by ingest, with each column read into a numpy array the
+    first time a query uses it. String columns are arrays of dictionary
+    codes, so grouping by one is a bincount over small integers.
+    """
+
+    def __init__(self, directory=TABLE_DIRECTORY):
+        if numpy is None:
+            raise RuntimeError("querying HAR tables needs the numpy package")
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE), encoding="utf-8") as file:
+            meta = json.load(file)
+        if meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"HAR table {directory} was written on a {meta['byteorder']} endian machine")
+        self.rows = meta["rows"]
+        self.meta = meta["columns"]
+        self.arrays = {}
+
+    def read(self, filename, typecode):
+        values = self.arrays.get(filename)
+        if values is None:
+            values = self.arrays[filename] = numpy.fromfile(os.path.join(self.directory, filename), numpy.dtype(typecode))
+        return values
+
+    def __getitem__(self, name):
+        return self.read(name + ".bin", self.meta[name]["type"])
+
+    def offsets(self, name):
+        """
+        Where each row's items start in a list column, with the total at the end
+        """
+        return self.read(name + ".offsets.bin", "q")
+
+    def is_list(self, name):
+        return self.meta[name].get("list", False)
+
+    def dictionary(self, name):
+        return self.meta[name].get("dictionary")
+
+    def equals(self, name, value):
+        """
+        A mask of the rows where a (non-list) column is value
+        """
+        dictionary = self.dictionary(name)
+        if dictionary is None:
+            return self[name] == value
+        try:
+            return self[name] == dictionary.index(value)
+        except ValueError:
+            return numpy.zeros(self.rows, bool)
+
+    def group_by(self, key, value=None, how="count", mask=None):
+        """
+        Aggregate rows (or for a list column, list items) by key: "count"
+        them, or "sum" or "mean" the value column, over the rows in mask
+        if given. Unknown (-1) values count as 0. Returns (groups,
+        amounts) for the groups with at least one row; groups of a string
+        column are dictionary codes.
+        """
+        if how in ("sum", "mean") and value is None:
+            raise ValueError(f"{how!r} needs a value column")
+        keys = self[key]
+        # for a list column, the row each item belongs to
+        rows = numpy.repeat(numpy.arange(self.rows), numpy.diff(self.offsets(key))) if self.is_list(key) else None
+        weights = None
+        if how != "count":
+            weights = numpy.clip(self[value], 0, None).astype(float)
+            if rows is not None:
+                weights = weights[rows]
+        if mask is not None:
+            selected = mask if rows is None else mask[rows]
+            keys = keys[selected]
+            if weights is not None:
+                weights = weights[selected]
+
+        if self.dictionary(key) is not None:
+            groups = None
+            size = len(self.dictionary(key))
+        else:
+            groups, keys = numpy.unique(keys, return_inverse=True)
+            size = len(groups)
+        counts = numpy.bincount(keys, minlength=size)
+        if how == "count":
+            amounts = counts
+        elif how in ("sum", "mean"):
+            amounts = numpy.bincount(keys, weights, minlength=size)
+            if how == "mean":
+                amounts = amounts / numpy.maximum(counts, 1)
+        else:
+            raise ValueError(f"unknown aggregate {how!r}")
+
+        present = numpy.flatnonzero(counts)
+        return (present if groups is None else groups[present]), amounts[present]
+
+    def top_k(self, key, k=10, value=None, how=None, mask=None):
+        """
+        The k largest groups from group_by as [(group, amount)], with string
+        groups decoded. how defaults to "sum" with a value column and
+        "count" without.
+        """
+        how = how or ("sum" if value else "count")
+        groups, amounts = self.group_by(key, value, how, mask)
+        if len(amounts) > k:
+            top = numpy.argpartition(-amounts, k)[:k]
+        else:
+            top = numpy.arange(len(amounts))
+        top = top[numpy.argsort(-amounts[top], kind="stable")]
+        dictionary = self.dictionary(key)
+        return [(dictionary[group] if dictionary is not None else group.item(), amount.item())
+                for group, amount in zip(groups[top], amounts[top])]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flatten HAR files into a columnar table and query it")
+    parser.add_argument("--ingest", metavar="HAR_DIRECTORY", help="build the table from a directory of HAR files")
+    parser.add_argument("--table", default=TABLE_DIRECTORY, help="directory the table is kept in")
+    parser.add_argument("--top", metavar="COLUMN", help="column to group by, e.g. host, domain or response_cookies")
+    parser.add_argument("--by", metavar="COLUMN", help="column to add up per group, e.g. response_body_size (default: count rows)")
+    parser.add_argument("--how", choices=("count", "sum", "mean"))
+    parser.add_argument("--third-party", action="store_true", help="only requests to other sites' domains")
+    parser.add_argument("--site", help="only requests made while visiting this site")
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args(argv)
+    if args.how in ("sum", "mean") and not args.by:
+        parser.error(f"--how {args.how} needs --by")
+
+    if args.ingest:
+        start = time.perf_counter()
+        rows = ingest(args.ingest, args.table)
+        print(f"Ingested {rows} requests into {args.table} in {time.perf_counter() - start:.1f}s")
+    if args.top:
+        table = HARTable(args.table)
+        start = time.perf_counter()
+        mask = None
+        if args.third_party:
+            mask = table["third_party"].astype(bool)
+        if args.site:
+            site = table.equals("site", registrable_domain(args.site))
+            mask = site if mask is None else mask & site
+        results = table.top_k(args.top, args.k, args.by, args.how, mask)
+        elapsed = time.perf_counter() - start
+        print(f"\nTop {args.k} {args.top} by {args.by or 'requests'}:")
+        for group, amount in results:
+            print(f"{group}: {int(amount) if float(amount).is_integer() else round(amount, 3)}")
+        print(f"({table.rows} requests, {elapsed * 1000:.0f} ms)")
+
+
+if __name__ == "__main__":
+    main()
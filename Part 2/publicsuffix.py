@@ -0,0 +1,215 @@
+import argparse
+import functools
+import hashlib
+import os
+import re
+import urllib.request
+
+# the full list, fetched with "python publicsuffix.py --update"
+SUFFIX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "public_suffix_list.dat")
+# or the copy Linux distributions install with the publicsuffix package
+SYSTEM_SUFFIX_FILE = "/usr/share/publicsuffix/public_suffix_list.dat"
+SUFFIX_URL = "https://publicsuffix.org/list/public_suffix_list.dat"
+# host names whose registrable domain is remembered
+CACHE_SIZE = 1 << 16
+
+# used when there's no copy of the full list: the multi-label suffixes
+# seen most on popular sites, from the ICANN and private sections of the list.
+# Any single label not covered by a rule is a suffix anyway.
+BUILTIN_RULES = """
+ac.uk co.uk gov.uk ltd.uk me.uk net.uk nhs.uk org.uk plc.uk police.uk sch.uk
+asn.au com.au edu.au gov.au id.au net.au org.au
+ac.jp ad.jp co.jp ed.jp go.jp gr.jp lg.jp ne.jp or.jp
+com.br edu.br gov.br net.br org.br
+com.cn edu.cn gov.cn net.cn org.cn
+ac.in co.in edu.in firm.in gen.in gov.in ind.in net.in org.in
+ac.kr co.kr go.kr ne.kr or.kr
+com.mx edu.mx gob.mx org.mx
+ac.nz co.nz govt.nz net.nz org.nz
+ac.za co.za gov.za org.za
+com.tr edu.tr gov.tr net.tr org.tr
+com.tw edu.tw gov.tw net.tw org.tw
+com.hk edu.hk gov.hk net.hk org.hk
+com.sg edu.sg gov.sg net.sg org.sg
+ac.il co.il gov.il org.il
+ac.id co.id go.id or.id
+ac.th co.th go.th in.th
+com.ar com.bd com.co com.eg com.my com.ng com.pe com.ph com.pk com.sa com.ua com.ve com.vn
+com.pl net.pl org.pl co.ke
+appspot.com azurewebsites.net blogspot.com cloudfront.net elasticbeanstalk.com firebaseapp.com
+github.io githubusercontent.com herokuapp.com netlify.app pages.dev s3.amazonaws.com vercel.app
+web.app workers.dev
+"""
+
+# the [userinfo@]host[:port] part of scheme://...
+URL_AUTHORITY = re.compile(r"[^:/?#]+://([^/?#]*)")
+
+
+class PublicSuffixList:
+    """
+    Public suffix rules compiled into a trie of labels, last label first.
+    A node is a dict of child labels, with "$" set if a rule ends there and
+    "!" if an exception rule does. digest identifies the set of rules.
+    """
+
+    def __init__(self, rules):
+        rules = sorted(set(rules))
+        self.digest = hashlib.sha256("\n".join(rules).encode("utf-8")).hexdigest()[:16]
+        self.trie = {}
+        for rule in rules:
+            exception = rule.startswith("!")
+            node = self.trie
+            for label in reversed(rule.lstrip("!").split(".")):
+                node = node.setdefault(label, {})
+            node["!" if exception else "$"] = True
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Read the rules from a file in the publicsuffix.org format
+        """
+        rules = []
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                rule = line.split(maxsplit=1)[0] if line.strip() else ""
+                if not rule or rule.startswith("//"):
+                    continue
+                try:
+                    # host names in URLs are in their ASCII (punycode) form
+                    rule = rule.encode("idna").decode("ascii")
+                except UnicodeError:
+                    continue
+                rules.append(rule.lower())
+        return cls(rules)
+
+    def suffix_length(self, labels):
+        """
+        The number of labels at the end of labels that are a public suffix.
+        Exception rules beat wildcards and the longest match wins; with no
+        match at all the last label is the suffix.
+        """
+        length = 1
+        node = self.trie
+        for depth, label in enumerate(reversed(labels)):
+            child = node.get(label)
+            if child is not None and child.get("!"):
+                return depth
+            wildcard = node.get("*")
+            if wildcard is not None and wildcard.get("$"):
+                length = depth + 1
+            if child is None:
+                break
+            if child.get("$"):
+                length = depth + 1
+            node = child
+        return length
+
+    def registrable_domain(self, host):
+        """
+        The public suffix of host plus one more label (eTLD+1). A host
+        that's a public suffix itself, or an IP address, is its own domain.
+        """
+        host = normalize_host(host)
+        if not host or host[0] == "[" or host.replace(".", "").isdigit():
+            return host
+        labels = host.split(".")
+        length = self.suffix_length(labels)
+        if len(labels) <= length:
+            return host
+        return ".".join(labels[-length - 1:])
+
+
+def normalize_host(host):
+    # cookie domains start with a dot, fully qualified names end with one
+    return host.strip(".").lower()
+
+
+@functools.lru_cache(maxsize=None)
+def default_list():
+    for path in (SUFFIX_FILE, SYSTEM_SUFFIX_FILE):
+        if os.path.exists(path):
+            return PublicSuffixList.from_file(path)
+    return PublicSuffixList(BUILTIN_RULES.split())
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def registrable_domain(host):
+    return default_list().registrable_domain(host)
+
+
+class DomainIndex:
+    """
+    Interns registrable domains as small integers, so comparing two hosts'
+    domains is an integer comparison
+    """
+
+    def __init__(self):
+        self.ids = {}
+
+    def id(self, domain):
+        domain_id = self.ids.get(domain)
+        if domain_id is None:
+            domain_id = self.ids[domain] = len(self.ids)
+        return domain_id
+
+
+# ids are only meaningful within one process
+domains = DomainIndex()
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def domain_id(host):
+    """
+    The interned id of the registrable domain of host
+    """
+    return domains.id(registrable_domain(host))
+
+
+def url_host(url):
+    """
+    The host name of a URL, "" if it hasn't got one. IPv6 hosts keep their
+    brackets.
+    """
+    match = URL_AUTHORITY.match(url)
+    if match is None:
+        return ""
+    host = match.group(1)
+    # plain string checks, most URLs have neither
+    if "@" in host:
+        host = host.rpartition("@")[2]
+    if ":" in host:
+        host = host[: host.find("]") + 1] if host.startswith("[") else host.partition(":")[0]
+    return host.lower()
+
+
+def is_third_party(host, site_id):
+    """
+    Whether host is under a different registrable domain than the one
+    with site_id
+    """
+    return domain_id(host) != site_id
+
+
+def update(path=SUFFIX_FILE, url=SUFFIX_URL):
+    with urllib.request.urlopen(url, timeout=30) as response:
+        data = response.read()
+    with open(path + ".part", "wb") as file:
+        file.write(data)
+    os.replace(path + ".part", path)
+    print(f"Saved {len(data)} bytes of public suffix rules to {path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find the registrable domain (eTLD+1) of host names")
+    parser.add_argument("hosts", nargs="*")
+    parser.add_argument("--update", action="store_true", help=f"download the full public suffix list from {SUFFIX_URL}")
+    args = parser.parse_args(argv)
+
+    if args.update:
+        update()
+    for host in args.hosts:
+        print(f"{host}: {registrable_domain(host)}")
+
+
+if __name__ == "__main__":
+    main()